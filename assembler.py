@@ -8,7 +8,9 @@ import sugar
 
 
 builtin_items = [getattr(wsbuiltin, name) for name in dir(wsbuiltin)]
-ASSEMBLER_TABLE = {c.NAME: c for c in builtin_items if hasattr(c, 'NAME')}
+# only the operations with WhiteSpace source, not the abstract classes nor
+# superinstructions
+ASSEMBLER_TABLE = {c.NAME: c for c in builtin_items if getattr(c, 'SRC', '')}
 sugar_items = [getattr(sugar, name) for name in dir(sugar)]
 SUGAR_TABLE = {c.NAME: c for c in sugar_items if hasattr(c, 'NAME')}
 
@@ -49,10 +51,12 @@ class AssemblerReader(object):
 
 
 class Assembler(object):
-    def __init__(self, reader, arg_sep):
+    def __init__(self, reader, arg_sep, unbox=False):
         self.reader = reader
         self.source = reader.source
         self.arg_sep = arg_sep
+        # if True, lower NUMBER arguments to plain int
+        self.unbox = unbox
         self.src, self.ins = self.tokenize()
 
     def tokenize(self):
@@ -68,7 +72,7 @@ class Assembler(object):
                 pos += 1
                 continue
             if ins not in ASSEMBLER_TABLE:
-                raise SyntaxError
+                raise SyntaxError("Unknown instruction {}".format(ins))
             ins = ASSEMBLER_TABLE[ins]
             if remain:
                 if issubclass(ins, FlowOperation):
@@ -77,6 +81,8 @@ class Assembler(object):
                 else:
                     literal = Assembler.literal_number(remain)
                     val = NUMBER(literal)
+                    if self.unbox:
+                        val = val.val
                 src.append(ins.SRC + self.arg_sep + literal + 'L')
                 tokens.append(ins(val))
             else:
@@ -99,10 +105,8 @@ class Assembler(object):
                 literal = literal[1:]
                 negative = True
             literal = bin(int(literal))[2:]
-        if negative:
-            literal = '1' + literal.translate({ord('0'): '1', ord('1'): '0'})
-        else:
-            literal = '0' + literal
+        # a sign, then the magnitude
+        literal = ('1' if negative else '0') + literal
         return literal.translate({ord('0'): 'S', ord('1'): 'T'})
 
     @staticmethod
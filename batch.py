@@ -0,0 +1,177 @@
+# encoding=utf-8
+"""
+Run many WhiteSpace jobs, a job being one program with one input,
+across a pool of processes.
+
+Every distinct program is compiled and linked once, in this process, and
+handed to each worker when it starts; the jobs are sent in chunks and only
+carry their program and input names. A job's stdout, final stack and heap
+are written as one JSON line.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import style as wsstyle
+from engine import PYWSEngine
+from program import Program
+from pyws import op_compiler, assembler
+
+# steps run between two checks of the time limit
+SLICE = 10000
+OK, STEP_LIMIT, TIME_LIMIT, ERROR = 'ok', 'step_limit', 'time_limit', 'error'
+
+# name => program.Program, in a worker
+_programs = {}
+
+
+def _init_worker(programs):
+    _programs.update(programs)
+
+
+def run_job(job, programs=None, max_steps=None, timeout=None):
+    """
+    Run job, (index, program name, input path or None), return its result
+    as a dict, which is ready for JSON
+    """
+    index, name, input_path = job
+    programs = _programs if programs is None else programs
+    result = {'job': index, 'program': name, 'input': input_path}
+    begin = time.perf_counter()
+    engine = None
+    try:
+        data = b''
+        if input_path is not None:
+            with open(input_path, 'rb') as f:
+                data = f.read()
+        engine = PYWSEngine(programs[name], output=io.StringIO(), input=data)
+        deadline = None if timeout is None else begin + timeout
+        status = OK
+        while True:
+            budget = SLICE
+            if max_steps is not None:
+                left = max_steps - engine.steps
+                if left <= 0:
+                    status = STEP_LIMIT
+                    break
+                budget = left if deadline is None else min(left, SLICE)
+            if engine.run_steps(budget):
+                break
+            if deadline is not None and time.perf_counter() > deadline:
+                status = TIME_LIMIT
+                break
+        result['status'] = status
+    except Exception as e:
+        result['status'] = ERROR
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['time'] = time.perf_counter() - begin
+    if engine is not None:
+        engine.output.flush()
+        result['stdout'] = engine.output.target.getvalue()
+        result['steps'] = engine.steps
+        result['stack'] = [int(v) for v in engine.stack]
+        result['heap'] = {str(k): int(v) for k, v in engine.heap.items()}
+    return result
+
+
+def _run_job(job, max_steps, timeout):
+    return run_job(job, max_steps=max_steps, timeout=timeout)
+
+
+def compile_programs(sources, style=wsstyle.STL, strict=False, opt=0,
+                     assemble=False):
+    """
+    Compile and link every distinct source once,
+    return the dict from source to its program.Program
+    """
+    programs = {}
+    for src in sources:
+        if src in programs:
+            continue
+        if assemble:
+            _, ins = assembler(src, unbox=True, opt=opt)
+        else:
+            ins = op_compiler(src, style, strict, unbox=True, opt=opt)
+        programs[src] = Program(ins, source=src)
+    return programs
+
+
+def run_batch(jobs, programs, workers=None, chunksize=None, max_steps=None,
+              timeout=None):
+    """
+    Run jobs, (program name, input path or None) pairs, on programs,
+    the dict from name to program.Program, in workers processes (default:
+    every core), or in this process if workers is 0.
+    Yield the results in the order of jobs
+    """
+    jobs = [(index, name, path) for index, (name, path) in enumerate(jobs)]
+    if workers == 0:
+        for job in jobs:
+            yield run_job(job, programs, max_steps, timeout)
+        return
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(len(jobs) // (workers * 4), 1)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(programs,)) as executor:
+        yield from executor.map(_run_job, jobs, itertools.repeat(max_steps),
+                                itertools.repeat(timeout),
+                                chunksize=chunksize)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description="Run WhiteSpace programs on many inputs, in parallel, "
+                    "writing a JSON line per run.")
+    argparser.add_argument('programs', nargs='+',
+                           help='source strings or files')
+    argparser.add_argument('-i', dest='inputs', action='append',
+                           default=None,
+                           help='input file, may be repeated, every program '
+                                'runs on every input, default: no input')
+    argparser.add_argument('-A', dest='assemble', action='store_true',
+                           default=False,
+                           help='if given, the programs are WhiteSpace IR')
+    argparser.add_argument('-O', dest='opt', type=int, default=0,
+                           choices=(0, 1, 2), help='optimize level')
+    argparser.add_argument('--strict', dest='strict', default=False,
+                           action='store_true',
+                           help='use strict mode, default: False')
+    argparser.add_argument('--style', dest='style', default='ORIGIN',
+                           help='code style, STL, ORIGIN or GMH')
+    argparser.add_argument('-j', dest='workers', type=int, default=None,
+                           help='processes, 0 to run in this one, '
+                                'default: every core')
+    argparser.add_argument('--chunksize', dest='chunksize', type=int,
+                           default=None,
+                           help='jobs sent to a process at a time')
+    argparser.add_argument('--max-steps', dest='max_steps', type=int,
+                           default=None,
+                           help='stop a job after this many instructions')
+    argparser.add_argument('--timeout', dest='timeout', type=float,
+                           default=None,
+                           help='stop a job after this many seconds')
+    argparser.add_argument('-o', dest='out', default=None,
+                           help='JSON lines file, default: stdout')
+    args = argparser.parse_args(argv)
+    style = getattr(wsstyle, args.style, wsstyle.STL)
+    programs = compile_programs(args.programs, style, args.strict, args.opt,
+                                args.assemble)
+    jobs = itertools.product(args.programs, args.inputs or [None])
+    out = open(args.out, 'w') if args.out else sys.stdout
+    try:
+        for result in run_batch(jobs, programs, args.workers, args.chunksize,
+                                args.max_steps, args.timeout):
+            out.write(json.dumps(result) + '\n')
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
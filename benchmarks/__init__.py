@@ -0,0 +1,6 @@
+# encoding=utf-8
+"""
+Benchmarks of PYWS, run them by `python -m benchmarks`, see
+benchmarks.suite for the stages timed and benchmarks.programs for the
+programs.
+"""
@@ -0,0 +1,227 @@
+# encoding=utf-8
+"""
+The benchmark programs, written in WhiteSpace IR (see assembler) and
+generated here, so nothing is downloaded.
+
+Every program is a function of its size n, returning a BenchProgram
+(not a program.Program). hworld, fibonacci and hanoi are in the spirit of
+offical_example, the others are synthetic workloads for one hot path each.
+"""
+from collections import namedtuple
+
+# ir: the WhiteSpace IR, input: bytes for RCHR/RNUM,
+# output: what the program prints
+BenchProgram = namedtuple('BenchProgram', 'name ir input output')
+
+PROGRAMS = {}
+# the size of each program in a suite of scale 1
+SIZES = {}
+
+
+def program(size):
+    def register(fn):
+        PROGRAMS[fn.__name__] = fn
+        SIZES[fn.__name__] = size
+        return fn
+
+    return register
+
+
+def lines(*parts):
+    return '\n'.join(parts) + '\n'
+
+
+@program(200)
+def hworld(n):
+    """
+    Print "Hello, world!" n times, from a string pushed by PUSHS
+    """
+    ir = lines('PUSH 0', 'PUSH {}'.format(n), 'STORE',
+               'MARK 0',
+               'PUSH 0', 'RETRIEVE', 'JZ 9',
+               'PUSH 0', 'PUSH 10', 'PUSHS ~"Hello, world!"',
+               'MARK 1',
+               'DUP', 'JZ 2', 'PCHR', 'JUMP 1',
+               'MARK 2',
+               'POP',
+               'PUSH 0', 'PUSH 0', 'RETRIEVE', 'PUSH 1', 'SUB', 'STORE',
+               'JUMP 0',
+               'MARK 9',
+               'END')
+    return BenchProgram('hworld', ir, b'', 'Hello, world!\n' * n)
+
+
+@program(300)
+def fibonacci(n):
+    """
+    Print the first n Fibonacci numbers, growing into big ints
+    """
+    ir = lines('PUSH 0', 'PUSH {}'.format(n), 'STORE',
+               'PUSH 0', 'PUSH 1',
+               'MARK 0',
+               'PUSH 0', 'RETRIEVE', 'JZ 9',
+               'COPY 1', 'PNUM', 'PUSH 10', 'PCHR',
+               'SWAP', 'COPY 1', 'ADD',
+               'PUSH 0', 'PUSH 0', 'RETRIEVE', 'PUSH 1', 'SUB', 'STORE',
+               'JUMP 0',
+               'MARK 9',
+               'END')
+    out, a, b = [], 0, 1
+    for _ in range(n):
+        out.append('{}\n'.format(a))
+        a, b = b, a + b
+    return BenchProgram('fibonacci', ir, b'', ''.join(out))
+
+
+@program(10)
+def hanoi(n):
+    """
+    Print the moves of n discs, hanoi(n, from, to, via) recursing by CALL
+    """
+    ir = lines('PUSH {}'.format(n), 'PUSH 1', 'PUSH 3', 'PUSH 2', 'CALL 10',
+               'END',
+               # [n from to via]
+               'MARK 10',
+               'COPY 3', 'JZ 11',
+               'COPY 3', 'PUSH 1', 'SUB', 'COPY 3', 'COPY 2', 'COPY 4',
+               'CALL 10',
+               'COPY 2', 'PNUM', 'PUSH 32', 'PCHR',
+               'COPY 1', 'PNUM', 'PUSH 10', 'PCHR',
+               'COPY 3', 'PUSH 1', 'SUB', 'COPY 1', 'COPY 3', 'COPY 5',
+               'CALL 10',
+               'MARK 11',
+               'POP', 'POP', 'POP', 'POP',
+               'RET')
+    out = []
+
+    def move(k, src, dst, via):
+        if k:
+            move(k - 1, src, via, dst)
+            out.append('{} {}\n'.format(src, dst))
+            move(k - 1, via, dst, src)
+
+    move(n, 1, 3, 2)
+    return BenchProgram('hanoi', ir, b'', ''.join(out))
+
+
+@program(20000)
+def loop(n):
+    """
+    A tight arithmetic loop, the sum of i * i % 7 for i from n down to 1
+    """
+    ir = lines('PUSH 0', 'PUSH 0', 'STORE',
+               'PUSH {}'.format(n),
+               'MARK 30',
+               'DUP', 'JZ 31',
+               'PUSH 0', 'COPY 1', 'DUP', 'MUL', 'PUSH 7', 'MOD',
+               'PUSH 0', 'RETRIEVE', 'ADD', 'STORE',
+               'PUSH 1', 'SUB',
+               'JUMP 30',
+               'MARK 31',
+               'POP', 'PUSH 0', 'RETRIEVE', 'PNUM', 'PUSH 10', 'PCHR',
+               'END')
+    total = sum(i * i % 7 for i in range(1, n + 1))
+    return BenchProgram('loop', ir, b'', '{}\n'.format(total))
+
+
+@program(5000)
+def recursion(n):
+    """
+    The sum of 1 to n, by n nested CALLs
+    """
+    ir = lines('PUSH {}'.format(n), 'CALL 20', 'PNUM', 'PUSH 10', 'PCHR',
+               'END',
+               'MARK 20',
+               'DUP', 'JZ 21',
+               'DUP', 'PUSH 1', 'SUB', 'CALL 20', 'ADD',
+               'MARK 21',
+               'RET')
+    return BenchProgram('recursion', ir, b'', '{}\n'.format(n * (n + 1) // 2))
+
+
+@program(60)
+def sort(n):
+    """
+    Bubble sort n pseudo-random numbers in the heap, then print them,
+    heap[n] tells if a pass swapped any
+    """
+    values, seed = [], 12345
+    for _ in range(n):
+        seed = (seed * 1103515245 + 12345) % (1 << 31)
+        values.append(seed % 1000)
+    stores = []
+    for addr, val in enumerate(values):
+        stores += ['PUSH {}'.format(addr), 'PUSH {}'.format(val), 'STORE']
+    ir = lines(*stores,
+               'PUSH {}'.format(n), 'PUSH 0', 'STORE',
+               # a pass, [j]
+               'MARK 40',
+               'PUSH 0',
+               'MARK 41',
+               'DUP', 'PUSH {}'.format(n - 1), 'SUB', 'JZ 43',
+               'DUP', 'RETRIEVE', 'COPY 1', 'PUSH 1', 'ADD', 'RETRIEVE',
+               'DUP', 'COPY 2', 'SUB', 'JS 45',
+               'POP', 'POP', 'PUSH 1', 'ADD', 'JUMP 41',
+               # [j a b], swap them and mark the pass
+               'MARK 45',
+               'COPY 2', 'SWAP', 'STORE',
+               'COPY 1', 'PUSH 1', 'ADD', 'SWAP', 'STORE',
+               'PUSH {}'.format(n), 'PUSH 1', 'STORE',
+               'PUSH 1', 'ADD', 'JUMP 41',
+               'MARK 43',
+               'POP',
+               'PUSH {}'.format(n), 'RETRIEVE', 'JZ 46',
+               'PUSH {}'.format(n), 'PUSH 0', 'STORE',
+               'JUMP 40',
+               'MARK 46',
+               'PUSH 0',
+               'MARK 47',
+               'DUP', 'PUSH {}'.format(n), 'SUB', 'JZ 48',
+               'DUP', 'RETRIEVE', 'PNUM', 'PUSH 32', 'PCHR',
+               'PUSH 1', 'ADD', 'JUMP 47',
+               'MARK 48',
+               'POP', 'END')
+    out = ''.join('{} '.format(v) for v in sorted(values))
+    return BenchProgram('sort', ir, b'', out)
+
+
+@program(3000)
+def pushs(n):
+    """
+    Sum n numbers pushed by one large PUSHS
+    """
+    values = [i % 97 + 1 for i in range(n)]
+    ir = lines('PUSH 0', 'PUSH 0', 'STORE',
+               'PUSH 0',
+               'PUSHS [{}]'.format(','.join(map(str, values))),
+               'MARK 50',
+               'DUP', 'JZ 51',
+               'PUSH 0', 'RETRIEVE', 'ADD', 'PUSH 0', 'SWAP', 'STORE',
+               'JUMP 50',
+               'MARK 51',
+               'POP', 'PUSH 0', 'RETRIEVE', 'PNUM', 'PUSH 10', 'PCHR',
+               'END')
+    return BenchProgram('pushs', ir, b'', '{}\n'.format(sum(values)))
+
+
+@program(2000)
+def echo(n):
+    """
+    Echo n lines of input char by char, up to a '$'
+    """
+    text = ''.join('line {} of the input\n'.format(i) for i in range(n))
+    ir = lines('MARK 60',
+               'PUSH 0', 'RCHR',
+               'PUSH 0', 'RETRIEVE', 'DUP', 'PUSH 36', 'SUB', 'JZ 61',
+               'PCHR',
+               'JUMP 60',
+               'MARK 61',
+               'POP', 'END')
+    return BenchProgram('echo', ir, (text + '$').encode('ascii'), text)
+
+
+def build(name, scale=1.0):
+    """
+    The program called name, sized by scale
+    """
+    return PROGRAMS[name](max(int(SIZES[name] * scale), 1))
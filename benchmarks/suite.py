@@ -0,0 +1,210 @@
+# encoding=utf-8
+"""
+Time every stage of PYWS on the benchmark programs, and compare the
+results with a baseline saved in JSON.
+
+The stages are:
+    reader    Reader filtering the whitespace source into STL
+    lexer     Lexer on the STL code
+    compile   op_compiler, from the source, without the disk cache
+    assemble  Assembler on the WhiteSpace IR
+    run       PYWSEngine.run, output into memory
+
+Each stage is timed as the best of `repeat` runs, and once more under
+tracemalloc for its memory peak.
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cache
+import style as wsstyle
+from assembler import Assembler, AssemblerReader
+from engine import PYWSEngine
+from pyws import op_compiler, __version__
+from wslexer import Reader, Lexer
+
+from benchmarks.programs import PROGRAMS, build
+
+STAGES = ('reader', 'lexer', 'compile', 'assemble', 'run')
+FORMAT = 1
+
+
+def prepare(prog):
+    """
+    Return the stage functions over prog, in the ORIGIN style
+    """
+    code = ''.join(Assembler(AssemblerReader(prog.ir), arg_sep='').src)
+    source = code.translate({ord(op): c for c, op in wsstyle.ORIGIN.items()})
+    # read once, so the lexer is timed on its own
+    lexed = Reader(code)
+    lexed.code
+    ins = op_compiler(source, wsstyle.ORIGIN, unbox=True)
+
+    def run():
+        engine = PYWSEngine(ins, output=io.StringIO(), input=prog.input)
+        engine.run()
+        engine.output.flush()
+        return engine.output.target.getvalue()
+
+    return {
+        'reader': lambda: Reader(source, wsstyle.ORIGIN).code,
+        'lexer': lambda: Lexer(lexed).lex(),
+        'compile': lambda: op_compiler(source, wsstyle.ORIGIN, unbox=True),
+        'assemble': lambda: Assembler(AssemblerReader(prog.ir), arg_sep=';',
+                                      unbox=True),
+        'run': run,
+    }
+
+
+def measure(fn, repeat):
+    """
+    Return the best time of repeat calls of fn, and its memory peak
+    """
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        spent = time.perf_counter() - begin
+        if best is None or spent < best:
+            best = spent
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_suite(names=None, stages=STAGES, repeat=3, scale=1.0, log=None):
+    """
+    Benchmark the programs called names (default: all) on stages,
+    return the results, which can be saved as JSON.
+
+    A program printing something other than it should raises
+    AssertionError, so a broken engine is never timed as a fast one.
+    """
+    names = names or sorted(PROGRAMS)
+    results = {}
+    enabled = cache.settings['enabled']
+    cache.configure(enabled=False)
+    try:
+        for name in names:
+            prog = build(name, scale)
+            fns = prepare(prog)
+            out = fns['run']()
+            if out != prog.output:
+                raise AssertionError("{} printed {!r}, not {!r}".format(
+                    name, out[:80], prog.output[:80]))
+            results[name] = {}
+            for stage in stages:
+                spent, peak = measure(fns[stage], repeat)
+                results[name][stage] = {'time': spent, 'peak': peak}
+                if log is not None:
+                    log('{:<12}{:<10}{:>12.6f}s{:>12} bytes'.format(
+                        name, stage, spent, peak))
+    finally:
+        cache.configure(enabled=enabled)
+    return {'format': FORMAT,
+            'pyws': __version__,
+            'python': platform.python_version(),
+            'scale': scale,
+            'results': results}
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    if report.get('format') != FORMAT:
+        raise ValueError("Not a PYWS benchmark baseline: {}".format(path))
+    return report
+
+
+def compare(report, baseline, threshold=0.25):
+    """
+    Compare report with baseline, return rows of (program, stage, metric,
+    baseline value, new value, ratio, regressed), for every measure both
+    have. A measure regressed if it grew by more than threshold.
+    """
+    rows = []
+    old = baseline['results']
+    for name, stages in sorted(report['results'].items()):
+        for stage, metrics in sorted(stages.items()):
+            before = old.get(name, {}).get(stage)
+            if before is None:
+                continue
+            for metric in ('time', 'peak'):
+                if metric not in before:
+                    continue
+                a, b = before[metric], metrics[metric]
+                ratio = b / a if a else float('inf') if b else 1.0
+                rows.append((name, stage, metric, a, b, ratio,
+                             ratio > 1 + threshold))
+    return rows
+
+
+def format_comparison(rows):
+    lines = ['{:<12}{:<10}{:<6}{:>14}{:>14}{:>8}'.format(
+        'program', 'stage', '', 'baseline', 'now', 'ratio')]
+    for name, stage, metric, a, b, ratio, regressed in rows:
+        if metric == 'time':
+            a, b = '{:.6f}s'.format(a), '{:.6f}s'.format(b)
+        lines.append('{:<12}{:<10}{:<6}{:>14}{:>14}{:>8.2f}{}'.format(
+            name, stage, metric, a, b, ratio, '  !' if regressed else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description="Benchmark the reader, lexer, compilers and engine "
+                    "of PYWS.")
+    argparser.add_argument('programs', nargs='*',
+                           help='programs to run, default: all of '
+                                + ', '.join(sorted(PROGRAMS)))
+    argparser.add_argument('--stage', dest='stages', action='append',
+                           choices=STAGES,
+                           help='stage to time, may be repeated, '
+                                'default: all')
+    argparser.add_argument('-n', dest='repeat', type=int, default=3,
+                           help='runs of each stage, the best one counts, '
+                                'default: 3')
+    argparser.add_argument('--scale', dest='scale', type=float, default=1.0,
+                           help='size of the programs, default: 1.0')
+    argparser.add_argument('--save', dest='save', default=None,
+                           help='if given, save the results as a baseline')
+    argparser.add_argument('--compare', dest='compare', default=None,
+                           help='if given, compare with this baseline, and '
+                                'exit with 1 on regressions')
+    argparser.add_argument('--threshold', dest='threshold', type=float,
+                           default=0.25,
+                           help='relative growth counted as a regression, '
+                                'default: 0.25')
+    args = argparser.parse_args(argv)
+    for name in args.programs:
+        if name not in PROGRAMS:
+            argparser.error("unknown program {}".format(name))
+    report = run_suite(args.programs, args.stages or STAGES, args.repeat,
+                       args.scale, log=print)
+    if args.save:
+        save(report, args.save)
+    if args.compare:
+        rows = compare(report, load(args.compare), args.threshold)
+        print(format_comparison(rows))
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+# encoding=utf-8
+"""
+Flat integer bytecode for WhiteSpace programs, and its interpreter.
+
+A program is encoded into an array('i') of opcodes and a parallel
+array('q') of operands. Operands which do not fit into 64 bits are kept in
+a side table of constants, their opcodes are flagged with BIG.
+Jump operands are the pc right after the MARK they jump to, so they need no
+label lookup at all.
+"""
+from array import array
+
+from wsbuiltin import PUSH, POP, DUP, COPY, SKIP, SWAP
+from wsbuiltin import STORE, RETRIEVE
+from wsbuiltin import ADD, SUB, MUL, DIV, MOD
+from wsbuiltin import PCHR, PNUM, RCHR, RNUM
+from wsbuiltin import MARK, CALL, JUMP, JZ, JS, RET, END, PYFN
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ
+from wsbuiltin import JumpOperation, LABEL
+from engine import PYWSEngine, FINISHED, EXHAUSTED, BLOCKED
+from linker import LinkError
+from program import Program
+from memory import INT64_MIN, INT64_MAX
+from wsio import WouldBlock
+
+OPCODES = [PUSH, POP, DUP, COPY, SKIP, SWAP,
+           STORE, RETRIEVE,
+           ADD, SUB, MUL, DIV, MOD,
+           PCHR, PNUM, RCHR, RNUM,
+           MARK, CALL, JUMP, JZ, JS, RET, END, PYFN,
+           ADDI, LOADK, STOREK, DUPJZ]
+OPCODE_OF = {cls: code for code, cls in enumerate(OPCODES)}
+# the name of the only operand of each operation class
+OPERAND_OF = {PUSH: 'val', COPY: 'index', SKIP: 'n', ADDI: 'val',
+              LOADK: 'key', MARK: 'label', PYFN: 'label'}
+
+(OP_PUSH, OP_POP, OP_DUP, OP_COPY, OP_SKIP, OP_SWAP,
+ OP_STORE, OP_RETRIEVE,
+ OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_MOD,
+ OP_PCHR, OP_PNUM, OP_RCHR, OP_RNUM,
+ OP_MARK, OP_CALL, OP_JUMP, OP_JZ, OP_JS, OP_RET, OP_END, OP_PYFN,
+ OP_ADDI, OP_LOADK, OP_STOREK, OP_DUPJZ) = range(len(OPCODES))
+
+# operand is an index into Bytecode.consts
+BIG = 0x100
+
+
+class Bytecode(object):
+    """
+    An encoded program: opcodes, operands and the big constant side table
+    """
+
+    def __init__(self, code=None, args=None, consts=None):
+        self.code = code if code is not None else array('i')
+        self.args = args if args is not None else array('q')
+        self.consts = consts if consts is not None else []
+
+    def __len__(self):
+        return len(self.code)
+
+    def __eq__(self, other):
+        return (isinstance(other, Bytecode) and
+                self.code == other.code and
+                self.args == other.args and
+                self.consts == other.consts)
+
+    def emit(self, opcode, arg=0):
+        if not INT64_MIN <= arg <= INT64_MAX:
+            self.consts.append(arg)
+            opcode, arg = opcode | BIG, len(self.consts) - 1
+        self.code.append(opcode)
+        self.args.append(arg)
+
+    def operand(self, pc):
+        if self.code[pc] & BIG:
+            return self.consts[self.args[pc]]
+        return self.args[pc]
+
+    def decode_at(self, pc):
+        """
+        Return the WSOperation at pc
+        """
+        cls = OPCODES[self.code[pc] & ~BIG]
+        if cls is STOREK:
+            return STOREK(*self.consts[self.args[pc]])
+        if cls in (MARK, PYFN):
+            return cls(LABEL(self.operand(pc)))
+        if issubclass(cls, JumpOperation):
+            return cls(LABEL(self.operand(self.args[pc] - 1)))
+        if cls in OPERAND_OF:
+            return cls(self.operand(pc))
+        return cls()
+
+    def decode(self):
+        """
+        Decode back into a list of WSOperations
+        """
+        return [self.decode_at(pc) for pc in range(len(self.code))]
+
+    def nbytes(self):
+        return (self.code.itemsize * len(self.code) +
+                self.args.itemsize * len(self.args))
+
+
+def encode(ins):
+    """
+    Give a list of WSOperations (not linked), or a program.Program,
+    return its Bytecode
+    """
+    if isinstance(ins, Program):
+        # put the MARKs back before the pcs of the labels
+        marks = {}
+        for label, pc in ins.labels.items():
+            marks.setdefault(pc, []).append(MARK(label))
+        source = []
+        for pc, op in enumerate(ins.ins):
+            source.extend(marks.get(pc, ()))
+            source.append(op)
+        source.extend(marks.get(len(ins), ()))
+        ins = source
+    labels = {}
+    for pc, op in enumerate(ins):
+        if isinstance(op, MARK):
+            if op.label in labels:
+                raise LinkError("Duplicate label {}".format(op.label))
+            labels[op.label] = pc + 1
+    bc = Bytecode()
+    for op in ins:
+        cls = type(op)
+        if cls not in OPCODE_OF:
+            raise TypeError("Cannot encode {!r}".format(op))
+        opcode = OPCODE_OF[cls]
+        if cls is STOREK:
+            bc.consts.append((int(op.key), int(op.val)))
+            bc.emit(opcode, len(bc.consts) - 1)
+        elif issubclass(cls, JumpOperation):
+            if op.label not in labels:
+                raise LinkError("Undefined label {}".format(op.label))
+            bc.emit(opcode, labels[op.label])
+        elif cls in OPERAND_OF:
+            val = getattr(op, OPERAND_OF[cls])
+            bc.emit(opcode, int(val.val if cls in (MARK, PYFN) else val))
+        else:
+            bc.emit(opcode)
+    return bc
+
+
+class BytecodeEngine(PYWSEngine):
+    """
+    The engine running Bytecode, by branching on the opcode integers.
+
+    The bytecode is loaded once into lists of opcodes and operands, with
+    big operands and STOREK constants resolved, and PYFN decoded, so no
+    step looks anything up in the side table.
+    """
+
+    def __init__(self, bytecode: Bytecode, stack=None, heap=None,
+                 output=None, input=None):
+        super().__init__([], stack=stack, heap=heap, output=output,
+                         input=input)
+        self.bytecode = bytecode
+        self.ins_len = len(bytecode)
+        self.opcodes, self.operands = self.load(bytecode)
+
+    @staticmethod
+    def load(bc):
+        opcodes = [opcode & ~BIG for opcode in bc.code]
+        operands = []
+        for pc, opcode in enumerate(opcodes):
+            if opcode == OP_STOREK:
+                arg = bc.consts[bc.args[pc]]
+            elif opcode == OP_PYFN:
+                arg = bc.decode_at(pc)
+            else:
+                arg = bc.operand(pc)
+            operands.append(arg)
+        return opcodes, operands
+
+    def run(self, debug=False, traceall=False, max_steps=None):
+        """
+        debug and traceall run the decoded instructions on PYWSEngine.
+        max_steps works as for PYWSEngine.run
+        """
+        if max_steps is not None:
+            try:
+                done = self.run_bytecode(max_steps)
+            except WouldBlock:
+                return BLOCKED
+            finally:
+                self.output.flush()
+            return FINISHED if done else EXHAUSTED
+        if debug or traceall:
+            self.program = Program(self.bytecode.decode())
+            self.ins, self.labels = self.program.ins, self.program.labels
+            self.ins_len = len(self.ins)
+            return super().run(debug=debug, traceall=traceall)
+        try:
+            self.run_bytecode()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.output.flush()
+        return self.stack, self.heap
+
+    def run_bytecode(self, budget=None):
+        """
+        Run at most budget steps (default: all), return True if the
+        program has stopped
+        """
+        code, args = self.opcodes, self.operands
+        stack, heap, calls = self.stack, self.heap, self.call_stack
+        push, pop = stack.append, stack.pop
+        write = self.output.write
+        read_char, read_number = self.input.read_char, self.input.read_number
+        self.input.before_fill = self.output.flush
+        pc, end = self.pc, len(code)
+        # counts down to 0, or never gets there without a budget
+        left = -1 if budget is None else budget
+        if self.meet_end:
+            return True
+        try:
+            while pc < end and left:
+                left -= 1
+                op = code[pc]
+                if op == OP_PUSH:
+                    push(args[pc])
+                elif op == OP_ADDI:
+                    stack[-1] += args[pc]
+                elif op == OP_LOADK:
+                    push(heap[args[pc]])
+                elif op == OP_COPY:
+                    push(stack[-1 - args[pc]])
+                elif op == OP_DUP:
+                    push(stack[-1])
+                elif op == OP_JZ:
+                    if pop() == 0:
+                        pc = args[pc]
+                        continue
+                elif op == OP_DUPJZ:
+                    if stack[-1] == 0:
+                        pc = args[pc]
+                        continue
+                elif op == OP_JUMP:
+                    pc = args[pc]
+                    continue
+                elif op == OP_ADD:
+                    b = pop()
+                    stack[-1] += b
+                elif op == OP_SUB:
+                    b = pop()
+                    stack[-1] -= b
+                elif op == OP_STORE:
+                    val = pop()
+                    heap[pop()] = val
+                elif op == OP_RETRIEVE:
+                    push(heap[pop()])
+                elif op == OP_CALL:
+                    calls.append(pc)
+                    pc = args[pc]
+                    continue
+                elif op == OP_RET:
+                    if calls:
+                        pc = calls.pop()
+                elif op == OP_POP:
+                    pop()
+                elif op == OP_SWAP:
+                    stack[-1], stack[-2] = stack[-2], stack[-1]
+                elif op == OP_STOREK:
+                    key, val = args[pc]
+                    heap[key] = val
+                elif op == OP_JS:
+                    if pop() < 0:
+                        pc = args[pc]
+                        continue
+                elif op == OP_MUL:
+                    b = pop()
+                    stack[-1] *= b
+                elif op == OP_DIV:
+                    b = pop()
+                    stack[-1] //= b
+                elif op == OP_MOD:
+                    b = pop()
+                    stack[-1] %= b
+                elif op == OP_PCHR:
+                    write(chr(pop()))
+                elif op == OP_PNUM:
+                    write(str(pop()))
+                elif op == OP_RCHR:
+                    # read first, the stack stays as it was on WouldBlock
+                    c = read_char()
+                    heap[pop()] = c
+                elif op == OP_RNUM:
+                    n = read_number()
+                    heap[pop()] = n
+                elif op == OP_SKIP:
+                    if not stack:
+                        raise IndexError("SKIP on an empty stack")
+                    if args[pc] > 0:
+                        del stack[-1 - args[pc]:-1]
+                elif op == OP_MARK:
+                    pass
+                elif op == OP_END:
+                    self.end()
+                    pc += 1
+                    break
+                else:
+                    # PYFN, decoded at load
+                    self.pc = pc
+                    args[pc](stack, heap, self.labels, self)
+                    pc = self.pc
+                pc += 1
+        except WouldBlock:
+            # the blocked step did not run
+            left += 1
+            raise
+        finally:
+            self.pc = pc
+            if budget is not None:
+                self.steps += budget - left
+        return self.meet_end or pc >= end
@@ -0,0 +1,172 @@
+# encoding=utf-8
+"""
+On-disk cache of compiled programs, like __pycache__ for WhiteSpace.
+
+Entries are pickled programs, named by the hash of everything the result
+depends on (source text, style, flags, and the code of the modules which
+compile and define the pickled operations, see code_key). Writes are atomic,
+and the least recently used entries are evicted to keep the directory
+under a size limit.
+
+Environment variables:
+    PYWS_CACHE_DIR   cache directory, default: ~/.cache/pyws
+    PYWS_CACHE_SIZE  size limit in bytes, default: 64MB
+    PYWS_NO_CACHE    if set, disable the cache
+"""
+import hashlib
+import importlib.util
+import os
+import pickle
+import tempfile
+
+SUFFIX = '.wsc'
+# bump when the layout of entries changes
+FORMAT = 1
+# the modules a cached program is built by, or made of
+MODULES = ('wsbuiltin', 'memory', 'wstoken', 'wslexer', 'style',
+           'assembler', 'sugar', 'optimizer', 'linker')
+_code_key = []
+
+settings = {
+    'dir': os.environ.get('PYWS_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'),
+                                       '.cache', 'pyws')),
+    'max_size': int(os.environ.get('PYWS_CACHE_SIZE', 64 * 1024 * 1024)),
+    'enabled': not os.environ.get('PYWS_NO_CACHE'),
+}
+
+
+def configure(directory=None, max_size=None, enabled=None):
+    """
+    Change where and how much to cache, None keeps the current setting
+    """
+    if directory is not None:
+        settings['dir'] = directory
+    if max_size is not None:
+        settings['max_size'] = max_size
+    if enabled is not None:
+        settings['enabled'] = enabled
+
+
+def source_key(src):
+    """
+    Return the code of src, which is the code itself, or the hash of the
+    file content if src is a path to it, read block by block
+    """
+    if isinstance(src, str) and os.path.exists(src):
+        h = hashlib.sha256()
+        with open(src, 'rb') as sf:
+            for block in iter(lambda: sf.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+    return src
+
+
+def code_key():
+    """
+    The hash of FORMAT and the source of MODULES, computed once, so any
+    change of the code misses the entries pickled before it
+    """
+    if not _code_key:
+        h = hashlib.sha256(str(FORMAT).encode('ascii'))
+        for name in MODULES:
+            h.update(name.encode('ascii') + b'\0')
+            spec = importlib.util.find_spec(name)
+            if spec is not None and spec.origin and \
+                    os.path.isfile(spec.origin):
+                with open(spec.origin, 'rb') as f:
+                    h.update(f.read())
+        _code_key.append(h.hexdigest())
+    return _code_key[0]
+
+
+def make_key(*parts):
+    """
+    Hash everything the cached program depends on, and code_key
+    """
+    h = hashlib.sha256(code_key().encode('ascii'))
+    for part in parts:
+        if isinstance(part, dict):
+            part = sorted(part.items())
+        h.update(repr(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def path_of(key):
+    return os.path.join(settings['dir'], key + SUFFIX)
+
+
+def load(key):
+    """
+    Return the cached program of key, or None
+    """
+    path = path_of(key)
+    try:
+        with open(path, 'rb') as f:
+            program = pickle.load(f)
+        # the mtime of an entry is its last use, for LRU eviction
+        os.utime(path)
+        return program
+    except Exception:
+        # unreadable, or pickled by incompatible code, rebuild it
+        return None
+
+
+def store(key, program):
+    """
+    Atomically write program to the cache, then evict the old entries
+    """
+    directory = settings['dir']
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(program, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path_of(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        evict()
+    except OSError:
+        # a cache we cannot write is only a slower cache
+        pass
+
+
+def evict():
+    """
+    Remove the least recently used entries until under the size limit
+    """
+    directory = settings['dir']
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(SUFFIX):
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= settings['max_size']:
+            break
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def cached(build, *parts):
+    """
+    Return build(), from the cache if already built with the same parts
+    """
+    if not settings['enabled']:
+        return build()
+    key = make_key(*parts)
+    program = load(key)
+    if program is None:
+        program = build()
+        store(key, program)
+    return program
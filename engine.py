@@ -1,62 +1,313 @@
 # encoding=utf-8
-from wsbuiltin import MARK, LABEL, NUMBER
-import copy
+from wsbuiltin import LABEL, NUMBER
+from wsio import sink_of, source_of, WouldBlock
+from memory import Heap, IntStack
+from program import Program
+from wstrace import Trace
+from wsprofile import Profile
 
 # This records `foreign` (for WhiteSpace) functions
 # See pyws.wsmark & PYWSEngine.foreign for more information
 PYFN_MAP = {}
 
+# what run returns, given max_steps
+FINISHED, EXHAUSTED, BLOCKED = 'finished', 'exhausted', 'blocked'
+
+
+class StackPromoted(Exception):
+    """
+    An operation has finished on the stack promoted from an IntStack,
+    the threaded code must be bound again
+    """
+
 
 class PYWSEngine(object):
     """
     The execute engine for PYWS.
     """
 
-    def __init__(self, ins: list, stack=None, heap=None):
-        # instruction is a list of callable that always return None
+    def __init__(self, ins, stack=None, heap=None, output=None,
+                 input=None, int64=False, trap=False):
+        # ins is a program.Program, shared with other engines as it is,
+        # or a list of callable that always return None, linked into one
+        # output is a target stream, fd or wsio.OutputSink,
+        # input is a source stream, fd, preloaded bytes or wsio.InputSource,
+        # see wsio
+        # int64 keeps the stack in a memory.IntStack, which is promoted to a
+        # list on overflow, or raises OverflowError if trap is given
         self.pc = 0
-        self.ins = ins
-        self.ins_len = len(ins)
+        if not isinstance(ins, Program):
+            ins = Program(ins)
+        self.program = ins
+        self.ins, self.labels = ins.ins, ins.labels
+        self.ins_len = len(self.ins)
         self.meet_end = False
-        self.labels = {}
-        self.history = []
-        self.buffer = []
-        if stack:
+        # a wstrace.Trace, if run with traceall
+        self.history = None
+        # a wsprofile.Profile, if run_profiled
+        self.profile = None
+        # the threaded code, kept until the stack, heap or IO is replaced,
+        # and the steps run by run_steps
+        self.code = None
+        self.steps = 0
+        self.trap = trap
+        if int64:
+            self.stack = IntStack(stack or ())
+        elif stack:
             self.stack = list(stack)
         else:
             self.stack = []
-        if heap:
+        if isinstance(heap, Heap):
             self.heap = heap
         else:
-            self.heap = {}
-        self.heap = {}
+            self.heap = Heap(heap)
         self.call_stack = []
-        for i, ins in enumerate(self.ins):
-            if isinstance(ins, MARK):
-                self.labels[ins.label] = i
+        self.output = sink_of(output)
+        self.input = source_of(input)
+        # reading may block, let everyone see the output before that;
+        # stdin is shared by engines, so each run claims it again
+        self.input.before_fill = self.output.flush
 
-    def run(self, debug=False, traceall=False):
+    def run(self, debug=False, traceall=False, max_steps=None):
         """
-        If debug is True, log history after every operation
+        If debug is True, log history after every operation.
+        If traceall is True, or a wstrace.Trace to record into, record the
+        changes of every operation into self.history.
+        When neither debug nor traceall is given, run the threaded fast path,
+        see PYWSEngine.run_threaded
+
+        If max_steps is given, run at most max_steps steps of the threaded
+        code and return FINISHED, EXHAUSTED if the steps ran out, or BLOCKED
+        if a wsio.FeedSource has no input for the next RCHR or RNUM.
+        Calling run again resumes the program in the last two cases.
         """
+        if max_steps is not None:
+            try:
+                return FINISHED if self.run_steps(max_steps) else EXHAUSTED
+            except WouldBlock:
+                return BLOCKED
+        if not (debug or traceall):
+            return self.run_threaded()
+        self.input.before_fill = self.output.flush
+        trace = None
         if traceall:
-            self.append_history(self.pc, None, self.stack, self.heap)
+            trace = traceall if isinstance(traceall, Trace) else Trace()
+            self.history = trace
+            trace.start(self)
         try:
             while self.has_next():
                 ins = self.next()
-                ins(self.stack, self.heap, self.labels, self, debug=debug)
-                if traceall:
-                    self.append_history(self.pc, None, self.stack, self.heap)
+                if trace is not None:
+                    trace.before(ins, self.stack)
+                try:
+                    ins(self.stack, self.heap, self.labels, self, debug=debug)
+                except OverflowError:
+                    # nothing is changed, run it again on the promoted stack
+                    if not self.promote_at(self.pc):
+                        raise
+                    continue
+                except StackPromoted:
+                    pass
+                if trace is not None:
+                    trace.after(self.pc, self.stack, self.heap)
                 self.pc += 1
         except KeyboardInterrupt:
             pass
+        finally:
+            self.output.flush()
+            if trace is not None:
+                trace.flush()
         return self.stack, self.heap
 
-    def append_history(self, pc, ins, stack, heap):
-        self.history.append((pc,
-                             ins,
-                             copy.deepcopy(stack),
-                             copy.deepcopy(heap)))
+    def thread(self):
+        """
+        Pre-bind every instruction into a closure which returns the next pc
+        """
+        return [ins.bind(self, pc) for pc, ins in enumerate(self.ins)]
+
+    def run_threaded(self):
+        """
+        Run the pre-bound closures, without any per-step attribute lookups
+        """
+        if self.code is None:
+            self.code = self.thread()
+        code = self.code
+        pc = self.pc
+        self.input.before_fill = self.output.flush
+        end = self.ins_len
+        try:
+            while not self.meet_end:
+                try:
+                    while pc < end:
+                        pc = code[pc]()
+                    break
+                except OverflowError:
+                    # nothing is changed, run it again on the promoted stack
+                    if not self.promote_at(pc):
+                        raise
+                except StackPromoted:
+                    pc = self.pc + 1
+                code = self.code = self.thread()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.output.flush()
+        self.pc = pc
+        return self.stack, self.heap
+
+    def run_steps(self, budget):
+        """
+        Run at most budget steps of the pre-bound closures, return True if
+        the program has stopped, or False if the budget ran out first.
+        The pc is kept, so the next call resumes where this one stopped.
+        self.steps counts the steps run so far
+        """
+        if self.code is None:
+            self.code = self.thread()
+        code = self.code
+        pc = self.pc
+        self.input.before_fill = self.output.flush
+        end = self.ins_len
+        left = budget
+        try:
+            while not self.meet_end:
+                try:
+                    while pc < end and left > 0:
+                        pc = code[pc]()
+                        left -= 1
+                    break
+                except OverflowError:
+                    if not self.promote_at(pc):
+                        raise
+                except StackPromoted:
+                    pc = self.pc + 1
+                    left -= 1
+                code = self.code = self.thread()
+        finally:
+            self.output.flush()
+            self.steps += budget - left
+            self.pc = pc
+        return self.meet_end or pc >= end
+
+    def run_profiled(self, profile=None):
+        """
+        Run the pre-bound closures like run_threaded, counting and timing
+        every step into profile, a wsprofile.Profile of this engine if not
+        given, which is kept in self.profile.
+
+        This is a loop of its own, so run_threaded pays nothing for it.
+        """
+        if profile is None:
+            profile = Profile(self)
+        self.profile = profile
+        self.input.before_fill = self.output.flush
+        code = self.thread()
+        pc = self.pc
+        end = self.ins_len
+        clock = profile.clock
+        counts, times, regions = profile.counts, profile.times, profile.regions
+        stacks, call_stack = profile.stacks, self.call_stack
+        started = clock()
+        try:
+            while not self.meet_end:
+                try:
+                    while pc < end:
+                        depth = len(call_stack)
+                        begin = clock()
+                        nxt = code[pc]()
+                        now = clock()
+                        spent = now - begin
+                        counts[pc] += 1
+                        times[pc] += spent
+                        key = (profile.path, regions[pc])
+                        stacks[key] = stacks.get(key, 0.0) + spent
+                        if len(call_stack) > depth:
+                            profile.enter(nxt, begin)
+                        elif len(call_stack) < depth:
+                            profile.leave(now)
+                        pc = nxt
+                    break
+                except OverflowError:
+                    if not self.promote_at(pc):
+                        raise
+                except StackPromoted:
+                    pc = self.pc + 1
+                code = self.thread()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.output.flush()
+            now = clock()
+            profile.finish(now, now - started)
+        self.pc = pc
+        return self.stack, self.heap
+
+    def run_native(self):
+        """
+        Run the instructions as one native Python function,
+        see transpiler.transpile
+
+        An IntStack overflowing here always raises OverflowError
+        """
+        program = self.program.native()
+        self.input.before_fill = self.output.flush
+        # the native code holds the IntStack, so it traps, even in foreign
+        trap, self.trap = self.trap, True
+        try:
+            if not self.meet_end:
+                program(self)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.trap = trap
+            self.output.flush()
+        return self.stack, self.heap
+
+    def promote_at(self, pc):
+        """
+        Promote the stack after an OverflowError of the operation at pc,
+        only if an IntStack refused what it stores, see WSOperation.WIDENS
+        """
+        return self.ins[pc].WIDENS and self.promote()
+
+    def promote(self):
+        """
+        Replace the IntStack with a list of the same items,
+        return False if there is nothing to promote, or overflow traps
+        """
+        if self.trap or not isinstance(self.stack, IntStack):
+            return False
+        self.stack = list(self.stack)
+        self.code = None
+        return True
+
+    def reset(self, stack=None, heap=None, input=None):
+        """
+        Make the engine ready to run the program again from the start, on
+        the items of stack and heap, and input if given. The stack and heap
+        are emptied in place, so the threaded code is kept.
+        """
+        self.pc = 0
+        self.meet_end = False
+        self.steps = 0
+        self.history = None
+        del self.call_stack[:]
+        del self.stack[:]
+        if stack:
+            try:
+                self.stack.extend(stack)
+            except OverflowError:
+                del self.stack[:]
+                if not self.promote():
+                    raise
+                self.stack.extend(stack)
+        self.heap.clear()
+        if heap:
+            self.heap.update(heap)
+        if input is not None:
+            self.input = source_of(input)
+            self.input.before_fill = self.output.flush
+            self.code = None
 
     def next(self):
         """
@@ -71,12 +322,12 @@ class PYWSEngine(object):
         """
         return self.pc < self.ins_len and not self.meet_end
 
-    def call(self, label):
+    def call(self, target):
         """
-        when meet CALL, store current pc for RET
+        when meet CALL, store current pc for RET, and go to the linked target
         """
         self.call_stack.append(self.pc)
-        self.pc = self.labels[label]
+        self.pc = target - 1
 
     def foreign(self, label):
         """
@@ -85,13 +336,28 @@ class PYWSEngine(object):
         """
         fn = PYFN_MAP.get(label, None)
         if fn:
+            # keep the order with anything the function prints
+            self.output.flush()
             argcount = fn.__code__.co_argcount
-            self.stack, args = self.stack[:-argcount], self.stack[-argcount:]
+            # keep the stack in place, the threaded engine holds its methods;
+            # a function without named args (like a wsfunction) takes it all
+            split = len(self.stack) - argcount if argcount else 0
+            args = self.stack[split:]
             retval = fn(*args)
-            if isinstance(retval, (LABEL, NUMBER, int)):
-                self.stack.append(retval)
-            else:
+            # fn may have run engines sharing our input
+            self.input.before_fill = self.output.flush
+            if not isinstance(retval, (LABEL, NUMBER, int)):
                 raise TypeError
+            try:
+                self.stack.append(retval)
+            except OverflowError:
+                # fn must not run again, so promote here and finish
+                if not self.promote():
+                    raise
+                self.stack.append(retval)
+                del self.stack[split:-1]
+                raise StackPromoted
+            del self.stack[split:-1]
 
     def ret(self):
         """
@@ -102,4 +368,5 @@ class PYWSEngine(object):
 
     def end(self):
         self.meet_end = True
+        self.output.flush()
 
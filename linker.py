@@ -0,0 +1,44 @@
+# encoding=utf-8
+"""
+Resolve labels into plain integer jump targets.
+"""
+import copy
+
+from wsbuiltin import MARK, JumpOperation
+
+
+class LinkError(SyntaxError):
+    pass
+
+
+def link(ins):
+    """
+    Give a list of WSOperations, return 2 values, the instructions without
+    MARKs, where every jump has its `target` set to the pc it jumps to, and
+    the dict from LABEL to that pc.
+
+    Undefined or duplicate labels raise LinkError.
+    A list which is already linked is returned as it is.
+    """
+    labels = {}
+    pos = 0
+    for op in ins:
+        if isinstance(op, MARK):
+            if op.label in labels:
+                raise LinkError("Duplicate label {}".format(op.label))
+            labels[op.label] = pos
+        else:
+            pos += 1
+    linked = []
+    for op in ins:
+        if isinstance(op, MARK):
+            continue
+        if isinstance(op, JumpOperation) and op.target is None:
+            if op.label not in labels:
+                raise LinkError("Undefined label {}".format(op.label))
+            op = copy.copy(op)
+            op.target = labels[op.label]
+        elif isinstance(op, JumpOperation):
+            labels.setdefault(op.label, op.target)
+        linked.append(op)
+    return linked, labels
@@ -0,0 +1,170 @@
+# encoding=utf-8
+"""
+Compact storage for the engine's heap.
+"""
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+
+class Missing(object):
+    """
+    Marks an unused cell of the dense region, stays the same object
+    through copy and pickle
+    """
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+class Heap(MutableMapping):
+    """
+    The heap of WhiteSpace, a mapping from address to value.
+
+    Small non-negative int addresses live in a growable list, `dense`,
+    every other key lives in the dict `sparse`. The dense region grows
+    geometrically, up to dense_limit cells.
+    """
+
+    def __init__(self, data=None, dense_limit=1 << 24):
+        self.dense = []
+        self.sparse = {}
+        self.dense_limit = dense_limit
+        if data:
+            self.update(data)
+
+    @staticmethod
+    def address(key):
+        """
+        int addresses as they are, NUMBERs as their value
+        """
+        if type(key) is not int and hasattr(key, '__index__'):
+            return key.__index__()
+        return key
+
+    def __getitem__(self, key):
+        # IndexError: beyond the dense region, TypeError: not an address
+        try:
+            if key >= 0:
+                val = self.dense[key]
+                if val is MISSING:
+                    raise KeyError(key)
+                return val
+        except (IndexError, TypeError):
+            pass
+        return self.sparse[self.address(key)]
+
+    def __setitem__(self, key, val):
+        try:
+            if key >= 0:
+                self.dense[key] = val
+                return
+        except (IndexError, TypeError):
+            pass
+        key = self.address(key)
+        size = len(self.dense)
+        if type(key) is int and size <= key < self.dense_limit and \
+                key < 2 * size + 64:
+            self.grow(key + 1)
+            self.dense[key] = val
+            return
+        self.sparse[key] = val
+
+    def grow(self, size):
+        """
+        Extend the dense region to at least size cells, moving the
+        covered sparse keys into it
+        """
+        dense = self.dense
+        start = len(dense)
+        size = min(max(size, 2 * start), self.dense_limit)
+        dense.extend([MISSING] * (size - start))
+        for key in [k for k in self.sparse
+                    if type(k) is int and start <= k < size]:
+            dense[key] = self.sparse.pop(key)
+
+    def __delitem__(self, key):
+        dense = self.dense
+        key = self.address(key)
+        if type(key) is int and 0 <= key < len(dense):
+            if dense[key] is MISSING:
+                raise KeyError(key)
+            dense[key] = MISSING
+            return
+        del self.sparse[key]
+
+    def __iter__(self):
+        for key, val in enumerate(self.dense):
+            if val is not MISSING:
+                yield key
+        yield from self.sparse
+
+    def __len__(self):
+        return (len(self.dense) - self.dense.count(MISSING) +
+                len(self.sparse))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def clear(self):
+        # in place, the threaded code holds the dense list
+        del self.dense[:]
+        self.sparse.clear()
+
+    def memory_usage(self):
+        """
+        Bytes used by the containers, not counting the values
+        """
+        return sys.getsizeof(self.dense) + sys.getsizeof(self.sparse)
+
+
+# the range of an IntStack item
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class IntStack(array):
+    """
+    The stack of WhiteSpace in 64-bit mode, an array('q') which behaves
+    like the list stack: it grows geometrically, compares equal to the list
+    of its items, and copies as one block.
+
+    Storing an int out of 64 bits raises OverflowError, and leaves the
+    stack as it was.
+    """
+
+    def __new__(cls, items=()):
+        return super().__new__(cls, 'q', items)
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return self.tolist() == other
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.tolist())
+
+    def __reduce_ex__(self, protocol):
+        return type(self), (self.tolist(),)
+
+    def clear(self):
+        del self[:]
+
+    def copy(self):
+        return type(self)(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
@@ -0,0 +1,83 @@
+# encoding=utf-8
+"""
+Peephole optimizer, fold constants and fuse common operation sequences
+into the superinstructions defined in wsbuiltin.
+
+It works on the instructions from op_compiler or Assembler, before
+linker.link, so a MARK always stops a pattern from crossing a label.
+"""
+import operator
+
+from wsbuiltin import PUSH, DUP, STORE, RETRIEVE
+from wsbuiltin import ADD, SUB, MUL, DIV, MOD
+from wsbuiltin import JZ
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ
+
+FOLDABLE = {ADD: operator.add, SUB: operator.sub, MUL: operator.mul,
+            DIV: operator.floordiv, MOD: operator.mod}
+
+
+def match(out, *classes):
+    """
+    Check if the tail of out are instances of given classes
+    """
+    if len(out) < len(classes):
+        return False
+    tail = out[-len(classes):]
+    return all(type(op) is cls for op, cls in zip(tail, classes))
+
+
+def reduce(out):
+    """
+    Rewrite the tail of out once, return True if anything changed
+    """
+    if len(out) >= 3 and type(out[-1]) in FOLDABLE and \
+            match(out[-3:-1], PUSH, PUSH):
+        a, b = int(out[-3].val), int(out[-2].val)
+        if type(out[-1]) in (DIV, MOD) and b == 0:
+            # keep the ZeroDivisionError at runtime
+            return False
+        val = FOLDABLE[type(out[-1])](a, b)
+        out[-3:] = [PUSH(val)]
+        return True
+    if match(out, PUSH, PUSH, STORE):
+        out[-3:] = [STOREK(out[-3].val, out[-2].val)]
+        return True
+    if match(out, PUSH, ADD):
+        out[-2:] = [ADDI(int(out[-2].val))]
+        return True
+    if match(out, PUSH, SUB):
+        out[-2:] = [ADDI(-int(out[-2].val))]
+        return True
+    if match(out, PUSH, ADDI):
+        out[-2:] = [PUSH(int(out[-2].val) + out[-1].val)]
+        return True
+    if match(out, ADDI, ADDI):
+        out[-2:] = [ADDI(out[-2].val + out[-1].val)]
+        return True
+    if match(out, PUSH, RETRIEVE):
+        out[-2:] = [LOADK(out[-2].val)]
+        return True
+    if match(out, DUP, JZ):
+        out[-2:] = [DUPJZ(out[-1].label)]
+        return True
+    return False
+
+
+def optimize(ins, level=1):
+    """
+    Give a list of WSOperations, return an optimized list
+    with observably identical results.
+
+    level 0: nothing changes
+    level 1: constant folding and superinstructions
+    level 2: the same as level 1
+    """
+    if level <= 0:
+        return list(ins)
+    out = []
+    for op in ins:
+        out.append(op)
+        while reduce(out):
+            pass
+    return out
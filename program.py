@@ -0,0 +1,100 @@
+# encoding=utf-8
+"""
+Compiled programs, linked once and shared by any number of engines.
+"""
+import hashlib
+from types import MappingProxyType
+
+from linker import link
+import transpiler
+
+
+class Program(object):
+    """
+    A linked program, which never changes after it is made, so engines in
+    any thread may run it at the same time.
+
+    ins: tuple of the instructions without MARKs, see linker.link
+    labels: read-only mapping from LABEL to pc
+    meta: read-only mapping of anything describing the program, like the
+          source it came from
+    """
+    __slots__ = ('ins', 'labels', 'meta', '_native', '_digest')
+
+    def __init__(self, ins, **meta):
+        if isinstance(ins, Program):
+            linked, labels = ins.ins, ins.labels
+            meta = dict(ins.meta, **meta)
+        else:
+            linked, labels = link(list(ins))
+        set_ = object.__setattr__
+        set_(self, 'ins', tuple(linked))
+        set_(self, 'labels', MappingProxyType(dict(labels)))
+        set_(self, 'meta', MappingProxyType(meta))
+        set_(self, '_native', None)
+        set_(self, '_digest', None)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("Program is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Program is immutable")
+
+    def __len__(self):
+        return len(self.ins)
+
+    def __iter__(self):
+        return iter(self.ins)
+
+    def __getitem__(self, pc):
+        return self.ins[pc]
+
+    def __eq__(self, other):
+        if not isinstance(other, Program):
+            return False
+        return self.ins == other.ins and self.labels == other.labels
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self.ins))
+
+    def __reduce__(self):
+        # linked instructions link as they are, keeping their targets
+        return _restore, (list(self.ins), dict(self.labels), dict(self.meta))
+
+    def native(self):
+        """
+        The native function of the program, see transpiler.load,
+        transpiled once for the program
+        """
+        if self._native is None:
+            object.__setattr__(self, '_native', transpiler.load(self.ins))
+        return self._native
+
+    def digest(self):
+        """
+        The SHA-256 of the instructions and labels, as bytes, the same for
+        equal programs in any process
+        """
+        if self._digest is None:
+            h = hashlib.sha256()
+            for op in self.ins:
+                h.update(repr(op).encode('utf-8'))
+                h.update(b'\0')
+            for label, pc in sorted((str(k), v) for k, v in
+                                    self.labels.items()):
+                h.update('{}={}\0'.format(label, pc).encode('utf-8'))
+            object.__setattr__(self, '_digest', h.digest())
+        return self._digest
+
+
+def _restore(ins, labels, meta):
+    program = Program.__new__(Program)
+    set_ = object.__setattr__
+    set_(program, 'ins', tuple(ins))
+    set_(program, 'labels', MappingProxyType(labels))
+    set_(program, 'meta', MappingProxyType(meta))
+    set_(program, '_native', None)
+    set_(program, '_digest', None)
+    return program
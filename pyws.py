@@ -1,69 +1,169 @@
 # encoding=utf-8
 
 import argparse
+import collections
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
 import style as wsstyle
 
+import cache
 from wslexer import Reader, Lexer
+from transpiler import transpile
+from optimizer import optimize
+from bytecode import Bytecode, BytecodeEngine, encode
 from assembler import Assembler, AssemblerReader
 from engine import PYWSEngine, PYFN_MAP
-from wsbuiltin import WSLiteral, LABEL, WSOperation
+from program import Program
+from wstrace import Trace
+from wsbuiltin import WSLiteral, LABEL, NUMBER, WSOperation, SuperInstruction
 
+__version__ = '0.2.0'
 
-def op_compiler(src: str, style: dict=wsstyle.STL, strict=False):
+
+def iter_ops(src: str, style: dict=wsstyle.STL, strict=False, unbox=False):
     """
-    Compile WhiteSpace codes into callable WSOperations
+    Lazily compile WhiteSpace codes into callable WSOperations,
+    the source is read and lexed chunk by chunk
     """
-    ins = []
     ins_buff = None
-    for token in Lexer(Reader(src, style), strict):
+    for token in Lexer(Reader(src, style), strict, lazy=True):
         if hasattr(token, 'ARGS'):
             if token.ARGS == 0:
                 # dealing operators
-                ins.append(token())
+                yield token()
             else:
                 ins_buff = token
         if isinstance(token, WSLiteral):
-            ins.append(ins_buff(token))
+            if unbox and isinstance(token, NUMBER):
+                token = token.val
+            yield ins_buff(token)
             ins_buff = None
-    return ins
 
 
-def ir_compiler(src: str, style: dict=wsstyle.STL, strict=False):
+def op_compiler(src: str, style: dict=wsstyle.STL, strict=False,
+                unbox=False, opt=0):
+    """
+    Compile WhiteSpace codes into callable WSOperations.
+    If unbox is True, NUMBER literals are lowered to plain int, so that
+    the arithmetic, heap and comparison run on native ints.
+    opt is the level for optimizer.optimize.
+
+    The result is cached on disk, see cache.
+    """
+
+    def build():
+        return optimize(iter_ops(src, style, strict, unbox), opt)
+
+    if not isinstance(src, str):
+        return build()
+    return cache.cached(build, 'op', cache.source_key(src), style, strict,
+                        unbox, opt, __version__)
+
+
+def iter_ir(src: str, style: dict=wsstyle.STL, strict=False):
     """
-    Compile WhiteSpace codes into WhiteSpace IR
+    Lazily compile WhiteSpace codes into lines of WhiteSpace IR
     """
-    ir = []
     last_operator = None
-    for token in Lexer(Reader(src, style), strict):
+    for token in Lexer(Reader(src, style), strict, lazy=True):
         if hasattr(token, 'ARGS'):
             if token.ARGS == 0:
                 # dealing stay-alone operators
-                ir.append(token.ir())
+                yield token.ir()
             else:
                 last_operator = token
-                continue
         if isinstance(token, WSLiteral):
-            ir.append('{} {}'.format(last_operator.ir(), token.ir()))
-        ir.append('\n')
-    return ''.join(ir).strip()
+            yield '{} {}'.format(last_operator.ir(), token.ir())
+
+
+def ir_compiler(src: str, style: dict=wsstyle.STL, strict=False, out=None):
+    """
+    Compile WhiteSpace codes into WhiteSpace IR.
+    If out is given, a path or a writable file, stream the IR into it
+    line by line instead of returning it
+    """
+    if out is None:
+        return '\n'.join(iter_ir(src, style, strict))
+    if isinstance(out, str):
+        with open(out, 'w') as f:
+            return ir_compiler(src, style, strict, f)
+    for line in iter_ir(src, style, strict):
+        out.write(line + '\n')
+
+
+def py_compiler(src: str, style: dict=wsstyle.STL, strict=False):
+    """
+    Compile WhiteSpace codes into the source of a native Python function
+    """
+    return transpile(op_compiler(src, style, strict))
+
+
+def run(ins, debug=False, traceall=False, native=False, bytecode=False,
+        int64=False):
+    """
+    Run given instructions, natively compiled if asked and not debugging,
+    or encoded into Bytecode if asked.
+    int64 keeps the stack in 64-bit ints, see memory.IntStack
+    """
+    if bytecode:
+        return BytecodeEngine(encode(ins)).run(debug=debug, traceall=traceall)
+    engine = PYWSEngine(ins, int64=int64)
+    if native and not (debug or traceall):
+        return engine.run_native()
+    return engine.run(debug=debug, traceall=traceall)
+
+
+def profile(ins, int64=False, table=True, stats=None, collapsed=None):
+    """
+    Run given instructions with PYWSEngine.run_profiled, print the table
+    of regions to stderr if asked, and write the profile to the pstats
+    file stats and the collapsed stacks file collapsed, if given.
+    Return the wsprofile.Profile
+    """
+    engine = PYWSEngine(ins, int64=int64)
+    engine.run_profiled()
+    if table:
+        print(engine.profile.table(), file=sys.stderr)
+    if stats:
+        engine.profile.dump_stats(stats)
+    if collapsed:
+        engine.profile.dump_collapsed(collapsed)
+    return engine.profile
 
 
 def disassembler(ins, sep=''):
     """
-    Give a list of callable WSOperators,
+    Give a list of callable WSOperators, or Bytecode,
     return the WhiteSpace IR, which can be read back again
-    by assembler
+    by assembler; superinstructions are expanded back
     """
+    if isinstance(ins, Bytecode):
+        ins = ins.decode()
+    ins = [base for op in ins for base in
+           (op.expand() if isinstance(op, SuperInstruction) else [op])]
     return sep.join(map(repr, ins))
 
 
-def assembler(src, sep=';', arg_sep=';'):
+def assembler(src, sep=';', arg_sep=';', unbox=False, opt=0):
     """
     Give a WhiteSpace IR file's path or a string contains the IR code,
-    return 2 values, STL code and instructions
+    return 2 values, STL code and instructions, optimized with level opt.
+
+    The result is cached on disk, see cache.
     """
-    a = Assembler(AssemblerReader(src), arg_sep=arg_sep)
-    return sep.join(a.src), a.ins
+
+    def build():
+        a = Assembler(AssemblerReader(src), arg_sep=arg_sep, unbox=unbox)
+        return sep.join(a.src), optimize(a.ins, opt)
+
+    if not isinstance(src, str):
+        return build()
+    return cache.cached(build, 'asm', cache.source_key(src), sep, arg_sep,
+                        unbox, opt, __version__)
 
 
 def dump_heap(heap):
@@ -90,6 +190,24 @@ def main():
     argparser.add_argument('--IR', dest='ir', action='store_true',
                            default=False,
                            help='if given, compile to WSIR instant of run it')
+    argparser.add_argument('--PY', dest='py', action='store_true',
+                           default=False,
+                           help='if given, compile to Python instant of '
+                                'run it')
+    argparser.add_argument('-O', dest='opt', type=int, default=0,
+                           choices=(0, 1, 2),
+                           help='optimize level, 1 for superinstructions, '
+                                '2 is the same as 1, default: 0')
+    argparser.add_argument('--bytecode', dest='bytecode', action='store_true',
+                           default=False,
+                           help='if given, run as encoded flat bytecode')
+    argparser.add_argument('--native', dest='native', action='store_true',
+                           default=False,
+                           help='if given, run as a compiled Python function')
+    argparser.add_argument('--int64', dest='int64', action='store_true',
+                           default=False,
+                           help='if given, keep the stack in 64-bit ints '
+                                'until one overflows')
     argparser.add_argument('--strict', dest='strict', default=False,
                            action='store_true',
                            help='use strict mode, default: False')
@@ -106,14 +224,37 @@ def main():
                            action='store_true',
                            help='if given, store heap and stack after EACH'
                                 'operator')
+    argparser.add_argument('--trace-file', dest='trace_file', default=None,
+                           help='if given, stream the trace of EACH operator '
+                                'to this file, see wstrace')
+    argparser.add_argument('--profile', dest='profile', default=False,
+                           action='store_true',
+                           help='if given, run with the profiler and print '
+                                'the time spent in each MARK region')
+    argparser.add_argument('--profile-stats', dest='profile_stats',
+                           default=None,
+                           help='if given, profile into this pstats file')
+    argparser.add_argument('--profile-collapsed', dest='profile_collapsed',
+                           default=None,
+                           help='if given, profile into this collapsed '
+                                'stacks file, for flame graphs')
     args = argparser.parse_args()
+    profiled = args.profile or args.profile_stats or args.profile_collapsed
+    if args.trace_file:
+        # only the tail of the run is kept in memory, the file has it all
+        args.traceall = Trace(ring=1 << 16, out=args.trace_file)
     if args.assemble:
-        code, ins = assembler(args.source, args.sep, args.arg_sep)
+        code, ins = assembler(args.source, args.sep, args.arg_sep,
+                              unbox=True, opt=args.opt)
         print('=' * 16)
         print('Compile result:')
         print(code)
-        stack, heap = PYWSEngine(ins).run(debug=args.debug,
-                                          traceall=args.traceall)
+        if profiled:
+            profile(ins, args.int64, args.profile, args.profile_stats,
+                    args.profile_collapsed)
+            return
+        stack, heap = run(ins, args.debug, args.traceall, args.native,
+                          args.bytecode, args.int64)
         if args.debug:
             print('=' * 16)
             print('STACK: ', stack)
@@ -126,19 +267,28 @@ def main():
         if args.ir:
             ir_code = ir_compiler(args.source, style, args.strict)
             print(ir_code)
+        elif args.py:
+            print(py_compiler(args.source, style, args.strict))
         else:
-            ins = op_compiler(args.source, style, args.strict)
-            stack, heap = PYWSEngine(ins).run(debug=args.debug,
-                                              traceall=args.traceall)
+            ins = op_compiler(args.source, style, args.strict, unbox=True,
+                              opt=args.opt)
+            if profiled:
+                profile(ins, args.int64, args.profile, args.profile_stats,
+                        args.profile_collapsed)
+                return
+            stack, heap = run(ins, args.debug, args.traceall, args.native,
+                          args.bytecode, args.int64)
             if args.debug:
                 print('=' * 16)
                 print('STACK: ', stack)
                 print(' HEAP: ', '\n', dump_heap(heap))
+    if isinstance(args.traceall, Trace):
+        args.traceall.close()
 
 
 def wsfunction(style=wsstyle.STL, strict=False, debug=False,
                stack_only=False, heap_only=False, stack_heap=False,
-               ret_top=True):
+               ret_top=True, native=False):
     """
     This decorator will make a callable function in Python, which is written in
     WhiteSpace.
@@ -151,6 +301,7 @@ def wsfunction(style=wsstyle.STL, strict=False, debug=False,
     :stack_only only return the whole stack. default: False
     :heap_only only return the whole heap. default: False
     :stack_heap return 2 values as stack, heap. default False
+    :native run as a compiled Python function, see transpiler. default: False
 
     This decorator ONLY cares 2 things: the amount of arguments, and the __doc__
 
@@ -164,30 +315,183 @@ def wsfunction(style=wsstyle.STL, strict=False, debug=False,
 
         dup_swap(1,2) # => [2, 1, 1]
 
+    The function also has .map(iterable) and .starmap(iterable), running
+    many calls in chunks over a pool, see wsmap.
+
     See test_pyws.test_wsXpy for more cases.
     """
 
     def _wsdef(func):
         src = func.__doc__
-        ins = op_compiler(src, style, strict)
+        program = Program(op_compiler(src, style, strict, unbox=True),
+                          source=src)
+        runner = _Runner(program, debug, stack_only, heap_only, stack_heap,
+                         ret_top, native)
+        # the idle engines of each thread, reset and run again by the next
+        # call; a call made while one runs (through PYFN) takes another
+        local = threading.local()
 
         def _wsfunc(*args, **kwargs):
-            engine = PYWSEngine(ins, stack=args, heap=kwargs)
-            stack, heap = engine.run(debug=debug)
-            if stack_only:
-                return stack
-            if heap_only:
-                return heap
-            if stack_heap:
-                return stack, heap
-            if ret_top:
-                return stack.pop()
-
+            idle = getattr(local, 'idle', None)
+            if idle is None:
+                idle = local.idle = []
+            result, engine = runner(idle.pop() if idle else None, args,
+                                    kwargs)
+            if engine is not None:
+                idle.append(engine)
+            return result
+
+        def _map(iterable, workers=None, chunksize=MAP_CHUNKSIZE,
+                 executor='process'):
+            """
+            Yield the results of calling with each item of iterable as the
+            only argument, in order, see wsmap
+            """
+            return wsmap(runner, ((item,) for item in iterable), workers,
+                         chunksize, executor)
+
+        def _starmap(iterable, workers=None, chunksize=MAP_CHUNKSIZE,
+                     executor='process'):
+            """
+            Yield the results of calling with each item of iterable as the
+            arguments, in order, see wsmap
+            """
+            return wsmap(runner, iterable, workers, chunksize, executor)
+
+        _wsfunc.program = program
+        _wsfunc.map = _map
+        _wsfunc.starmap = _starmap
         return _wsfunc
 
     return _wsdef
 
 
+# items of a chunk run by wsmap, a map of one chunk runs serially
+MAP_CHUNKSIZE = 1024
+
+
+class _Runner(object):
+    """
+    Run a wsfunction's Program and pick its result, picklable so chunks
+    of calls may run in other processes
+    """
+
+    def __init__(self, program, debug, stack_only, heap_only, stack_heap,
+                 ret_top, native):
+        self.program = program
+        self.debug = debug
+        self.stack_only = stack_only
+        self.heap_only = heap_only
+        self.stack_heap = stack_heap
+        self.ret_top = ret_top
+        self.native = native
+
+    def __call__(self, engine, args, kwargs):
+        """
+        Run on engine, or a new one if None, return the result, and the
+        engine if it may be reset and run again
+        """
+        if engine is None:
+            engine = PYWSEngine(self.program, stack=args, heap=kwargs)
+        else:
+            engine.reset(args, kwargs)
+        if self.native and not self.debug:
+            stack, heap = engine.run_native()
+        else:
+            stack, heap = engine.run(debug=self.debug)
+        # the stack and heap given away stay with the caller
+        if self.stack_only or self.heap_only or self.stack_heap:
+            return self.pick(stack, heap), None
+        return self.pick(stack, heap), engine
+
+    def pick(self, stack, heap):
+        """
+        The result of a call which has left stack and heap
+        """
+        if self.stack_only:
+            return stack
+        if self.heap_only:
+            return heap
+        if self.stack_heap:
+            return stack, heap
+        if self.ret_top:
+            return stack.pop()
+
+    def run_chunk(self, chunk):
+        """
+        The results of a list of argument tuples, on as few engines as
+        possible
+        """
+        results = []
+        engine = None
+        for args in chunk:
+            result, engine = self(engine, args, {})
+            results.append(result)
+        return results
+
+    def run_vector(self, chunk):
+        """
+        The results of a list of argument tuples, run in lockstep by
+        vector.VectorEngine, which needs NumPy
+        """
+        from vector import VectorEngine
+        engine = VectorEngine(self.program, chunk)
+        results = [self.pick(stack, heap) for stack, heap in engine.run()]
+        output = ''.join(engine.outputs)
+        if output:
+            sys.stdout.write(output)
+        return results
+
+
+def wsmap(runner, iterable, workers=None, chunksize=MAP_CHUNKSIZE,
+          executor='process'):
+    """
+    Yield runner's results of the argument tuples of iterable, in order.
+
+    The tuples are cut into chunks of chunksize, which run on workers
+    (default: every core) of executor: 'process', 'thread', or a
+    concurrent.futures.Executor to use as it is. An iterable of one chunk
+    or less runs in this thread. 'vector' runs every chunk in this thread,
+    with all its calls in lockstep, see vector.VectorEngine.
+    At most 2 * workers chunks are read ahead, so iterable may be endless.
+
+    Processes get PYFN functions only if they are forked.
+    """
+    items = iter(iterable)
+    chunk = list(itertools.islice(items, chunksize))
+    if executor == 'vector':
+        while chunk:
+            yield from runner.run_vector(chunk)
+            chunk = list(itertools.islice(items, chunksize))
+        return
+    if len(chunk) < chunksize:
+        yield from runner.run_chunk(chunk)
+        return
+    workers = workers or os.cpu_count() or 1
+    if isinstance(executor, Executor):
+        pool, own = executor, False
+    elif executor == 'process':
+        pool, own = ProcessPoolExecutor(workers), True
+    elif executor == 'thread':
+        pool, own = ThreadPoolExecutor(workers), True
+    else:
+        raise ValueError("Unknown executor {!r}".format(executor))
+    pending = collections.deque()
+    try:
+        while chunk:
+            pending.append(pool.submit(runner.run_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+            chunk = list(itertools.islice(items, chunksize))
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own:
+            pool.shutdown()
+
+
 def wsmark(label: str):
     """
     This decorator will register given function to engine.PYFN_MAP
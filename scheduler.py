@@ -0,0 +1,113 @@
+# encoding=utf-8
+"""
+Run many engines in one thread, taking turns, so no program can hog it.
+
+Every round, each task which can run gets a slice of `quantum * priority`
+steps, cut short by its quota of steps left; a task past its deadline is
+stopped before its turn. A task waiting on a wsio.FeedSource is skipped
+until it is fed. A program which raises only fails its own task.
+"""
+import time
+
+from engine import PYWSEngine, FINISHED, EXHAUSTED, BLOCKED
+
+# steps of a task of priority 1 in a round
+QUANTUM = 1000
+# the states of a Task, after FINISHED, EXHAUSTED (ready to run more),
+# or BLOCKED
+STEP_LIMIT, TIME_LIMIT, ERROR = 'step_limit', 'time_limit', 'error'
+DONE = (FINISHED, STEP_LIMIT, TIME_LIMIT, ERROR)
+
+
+class Task(object):
+    """
+    An engine run by a Scheduler.
+
+    status: EXHAUSTED until it has run, see the module constants
+    error: the exception the program raised, if status is ERROR
+    """
+
+    def __init__(self, engine, name=None, priority=1, max_steps=None,
+                 deadline=None):
+        self.engine = engine
+        self.name = name
+        self.priority = priority
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.status = EXHAUSTED
+        self.error = None
+
+    @property
+    def done(self):
+        return self.status in DONE
+
+    @property
+    def runnable(self):
+        if self.status == BLOCKED:
+            return self.engine.input.ready()
+        return not self.done
+
+    def __repr__(self):
+        return 'Task({!r}, {}, steps={})'.format(self.name, self.status,
+                                                 self.engine.steps)
+
+
+class Scheduler(object):
+    """
+    A round-robin scheduler of Tasks, weighted by priority
+    """
+
+    def __init__(self, quantum=QUANTUM, clock=time.monotonic):
+        self.quantum = quantum
+        self.clock = clock
+        self.tasks = []
+
+    def add(self, engine, name=None, priority=1, max_steps=None,
+            timeout=None):
+        """
+        Schedule engine, a PYWSEngine or the instructions to make one of,
+        to run at most max_steps steps in all, and to stop timeout seconds
+        from now. Return its Task
+        """
+        if not isinstance(engine, PYWSEngine):
+            engine = PYWSEngine(engine)
+        deadline = None if timeout is None else self.clock() + timeout
+        task = Task(engine, name, priority, max_steps, deadline)
+        self.tasks.append(task)
+        return task
+
+    def step(self):
+        """
+        Run one round, return the number of tasks which ran
+        """
+        ran = 0
+        for task in self.tasks:
+            if task.done:
+                continue
+            if task.deadline is not None and self.clock() >= task.deadline:
+                task.status = TIME_LIMIT
+                continue
+            if not task.runnable:
+                continue
+            budget = self.quantum * task.priority
+            if task.max_steps is not None:
+                left = task.max_steps - task.engine.steps
+                if left <= 0:
+                    task.status = STEP_LIMIT
+                    continue
+                budget = min(budget, left)
+            ran += 1
+            try:
+                task.status = task.engine.run(max_steps=budget)
+            except Exception as e:
+                task.status, task.error = ERROR, e
+        return ran
+
+    def run(self):
+        """
+        Run rounds until every task is done or blocked, return the tasks.
+        Once blocked tasks are fed, run again to resume them
+        """
+        while self.step():
+            pass
+        return self.tasks
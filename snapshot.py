@@ -0,0 +1,94 @@
+# encoding=utf-8
+"""
+Snapshots of paused engines, to resume them later, in any process.
+
+A snapshot is a compact binary blob: the digest of the program (see
+program.Program.digest), pc, steps, stack, heap, call stack and the
+unread input, with every number a zigzag varint (see wstrace). The program
+itself is not in it, load finds it by the digest.
+
+Take a snapshot between two steps, like after run(max_steps=...) returned
+EXHAUSTED or BLOCKED. The output is flushed, not saved.
+"""
+from engine import PYWSEngine
+from memory import IntStack
+from program import Program
+from wstrace import pack_uint, unpack_uint, pack_values, unpack_values
+from wstrace import pack_value, unpack_value
+
+MAGIC = b'PYWSSNP1'
+# flags
+ENDED, INT64, TRAP, EOF = 1, 2, 4, 8
+
+
+def dump(engine):
+    """
+    The snapshot of engine as bytes
+    """
+    engine.output.flush()
+    out = bytearray(MAGIC)
+    out += engine.program.digest()
+    source = engine.input
+    flags = (ENDED if engine.meet_end else 0) | \
+        (INT64 if isinstance(engine.stack, IntStack) else 0) | \
+        (TRAP if engine.trap else 0) | (EOF if source.eof else 0)
+    out.append(flags)
+    pack_uint(out, engine.pc)
+    pack_uint(out, engine.steps)
+    pack_values(out, engine.stack)
+    pack_uint(out, len(engine.heap))
+    for key, val in engine.heap.items():
+        pack_value(out, key)
+        pack_value(out, val)
+    pack_values(out, engine.call_stack)
+    unread = source.remaining()
+    pack_uint(out, len(unread))
+    out += unread
+    return bytes(out)
+
+
+def load(blob, programs, output=None, input=None, cls=PYWSEngine):
+    """
+    Make a cls engine from the snapshot blob, ready to resume.
+
+    programs: the program.Program the snapshot was taken of, or a
+              mapping from digest to Program
+    input: where to read after the input unread at the snapshot, needed
+           if the input had not ended then
+    """
+    blob = memoryview(blob)
+    if bytes(blob[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a PYWS snapshot")
+    pos = len(MAGIC)
+    digest = bytes(blob[pos:pos + 32])
+    pos += 32
+    if isinstance(programs, Program):
+        program = programs if programs.digest() == digest else None
+    else:
+        program = programs.get(digest)
+    if program is None:
+        raise ValueError("No program of digest {}".format(digest.hex()))
+    flags = blob[pos]
+    pc, pos = unpack_uint(blob, pos + 1)
+    steps, pos = unpack_uint(blob, pos)
+    stack, pos = unpack_values(blob, pos)
+    count, pos = unpack_uint(blob, pos)
+    heap = {}
+    for _ in range(count):
+        key, pos = unpack_value(blob, pos)
+        heap[key], pos = unpack_value(blob, pos)
+    calls, pos = unpack_values(blob, pos)
+    size, pos = unpack_uint(blob, pos)
+    unread = bytes(blob[pos:pos + size])
+    ended = flags & EOF
+    engine = cls(program, stack=stack, heap=heap, output=output,
+                 input=unread if ended else input,
+                 int64=bool(flags & INT64), trap=bool(flags & TRAP))
+    if not ended:
+        source = engine.input
+        source.data, source.pos = unread + source.remaining(), 0
+    engine.pc = pc
+    engine.steps = steps
+    engine.meet_end = bool(flags & ENDED)
+    engine.call_stack.extend(calls)
+    return engine
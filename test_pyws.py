@@ -1,10 +1,46 @@
 # from lexer import Lexer
+import asyncio
+import copy
+import io
+import itertools
+import os
+import pickle
+import pstats
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
 import style
-from wsbuiltin import ADD, PUSH, SUB, NUMBER, LABEL
-from wslexer import Reader
+import cache
+from wsbuiltin import ADD, PUSH, SUB, DUP, JUMP, MARK, END, NUMBER, LABEL
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ, MUL, SWAP, COPY, PYFN
+from wsbuiltin import SKIP, STORE, RETRIEVE, JZ, CALL, RET, RNUM, POP, PCHR
+from wslexer import Reader, Lexer
 from pyws import op_compiler, disassembler, assembler, wsfunction, wsmark, \
-    ir_compiler
-from engine import PYWSEngine
+    ir_compiler, py_compiler, iter_ops, dump_heap
+from engine import PYWSEngine, PYFN_MAP, FINISHED, EXHAUSTED, BLOCKED
+from linker import link, LinkError
+from optimizer import optimize
+from bytecode import BytecodeEngine, encode
+from wsio import OutputSink, InputSource, FeedSource
+from memory import Heap, IntStack
+from wstrace import Trace
+from wsprofile import Profile
+import wstrace
+from benchmarks import suite
+from benchmarks.programs import PROGRAMS, build
+import batch
+from program import Program
+from wsasync import AsyncPYWSEngine, serve
+from scheduler import Scheduler
+import scheduler
+import snapshot
+
+# never read or write the cache of the user, even for the wsfunctions
+# compiled below as the module loads, see test_cache
+cache.configure(enabled=False)
 
 
 def test_source():
@@ -36,6 +72,20 @@ def test_disassembler():
     assert "ADDSUB" == disassembler(op_compiler("TSSSTSST"))
     assert "ADD-SUB" == disassembler(op_compiler("TSSSTSST"), sep='-')
     assert "PUSH -10;DUP" == disassembler(op_compiler("SSTTSTSLSLS"), sep=';')
+    # superinstructions are expanded, so the IR reads back the same program
+    ins = [PUSH(3), MARK(LABEL('T')), DUP(), JZ(LABEL('TS')), PUSH(1), SUB(),
+           JUMP(LABEL('T')), MARK(LABEL('TS')), PUSH(1), PUSH(7), STORE(),
+           PUSH(1), RETRIEVE(), PUSH(2), ADD(), END()]
+    fused = optimize(ins, 1)
+    src = disassembler(fused, '\n')
+    assert src == disassembler(encode(fused), '\n')
+    assert PYWSEngine(ins).run() == \
+        PYWSEngine(assembler(src, unbox=True)[1]).run()
+    try:
+        assembler("ADDI 1")
+        assert False
+    except SyntaxError:
+        pass
 
 
 def test_literal():
@@ -56,6 +106,7 @@ def test_literal():
 def test_assembler():
     assert "SS;STSTSL" == assembler("PUSH 10")[0]
     assert "SS;SSL;SS;STL" == assembler("PUSHS [0,1]")[0]
+    assert "SS;TTSTSL" == assembler("PUSH -10")[0]
 
 
 def ws_run(src: str, style=style.STL) -> ([], {}):
@@ -98,3 +149,756 @@ def test_wsXpy():
     assert 6 == ws_run("SSSTTL;SSSTSL;LLSSTL")[0].pop()
     # PUSH 03 ; PUSH 02 ; PYFN -1
     assert 5 == ws_run("SSSTTL;SSSTSL;LLSTTL")[0].pop()
+
+
+def test_threaded_engine():
+    # PUSH 3 ; MARK 1 ; DUP ; JZ 2 ; PUSH -1 ; ADD ; JUMP 1 ; MARK 2
+    loop = "SSSTTL;LSSTL;SLS;LTSTSL;SSTTL;TSSS;LSLTL;LSSTSL"
+    assert ([0], {}) == ws_run(loop)
+    assert PYWSEngine(op_compiler(loop)).run(debug=True) == ws_run(loop)
+    # CALL 1 ; PUSH 2 ; END ; MARK 1 ; PUSH 1 ; RET
+    call = "LSTTL;SSSTSL;LLL;LSSTL;SSSTL;LTL"
+    assert ([1, 2], {}) == ws_run(call)
+    assert PYWSEngine(op_compiler(call)).run(traceall=True) == ws_run(call)
+
+
+def test_native():
+    # PUSH 3 ; MARK 1 ; DUP ; JZ 2 ; PUSH -1 ; ADD ; JUMP 1 ; MARK 2
+    loop = "SSSTTL;LSSTL;SLS;LTSTSL;SSTTL;TSSS;LSLTL;LSSTSL"
+    assert ([0], {}) == PYWSEngine(op_compiler(loop)).run_native()
+    # CALL 1 ; PUSH 2 ; END ; MARK 1 ; PUSH 1 ; RET
+    call = "LSTTL;SSSTSL;LLL;LSSTL;SSSTL;LTL"
+    assert ([1, 2], {}) == PYWSEngine(op_compiler(call)).run_native()
+    heap = "SSSTTL;SSSTL;TTS;SSSTTL;TTT"
+    assert ws_run(heap) == PYWSEngine(op_compiler(heap)).run_native()
+    assert py_compiler("SSSTL;SSSTTL;TSSS").startswith("def ws_program")
+    # PUSH 5 ; PUSH 3 ; SUB ; PUSH 7 ; PUSH 2 ; DIV
+    assert ([2, 3], {}) == PYWSEngine(
+        op_compiler("SSSTSTL;SSSTTL;TSST;SSSTTTL;SSSTSL;TSTS")).run_native()
+    assert 3 == native_add(1, 2)
+
+
+@wsfunction(native=True)
+def native_add(a, b):
+    """TSSS"""
+
+
+def test_link():
+    # MARK 1 ; PUSH 1 ; JUMP 1
+    ins, labels = link(op_compiler("LSSTL;SSSTL;LSLTL"))
+    assert [PUSH(NUMBER("ST")), JUMP(LABEL("T"))] == ins
+    assert 0 == ins[1].target
+    assert {LABEL("T"): 0} == labels
+    assert (ins, labels) == link(ins)
+    for src in ("LSLTL", "LSSTL;LSSTL"):
+        try:
+            link(op_compiler(src))
+            assert False
+        except LinkError:
+            pass
+
+
+def test_unbox():
+    assert [PUSH(NUMBER('STS'))] == op_compiler('SSSTSL', unbox=True)
+    assert int is type(op_compiler('SSSTSL', unbox=True)[0].val)
+    assert int is type(assembler("PUSH 10", unbox=True)[1][0].val)
+    # PUSH 5 ; PUSH 3 ; SUB ; PUSH 7 ; PUSH 2 ; DIV ; COPY 1
+    src = "SSSTSTL;SSSTTL;TSST;SSSTTTL;SSSTSL;TSTS;STSSTL"
+    for unbox in (False, True):
+        ins = op_compiler(src, unbox=unbox)
+        assert ([2, 3, 2], {}) == PYWSEngine(ins).run()
+        assert ([2, 3, 2], {}) == PYWSEngine(ins).run(debug=True)
+        assert ([2, 3, 2], {}) == PYWSEngine(ins).run_native()
+    assert 2 == 5 - NUMBER("STT")
+    assert 2 == NUMBER("STST") - 3
+    assert NUMBER("TT") < 0
+
+
+def test_optimize():
+    # PUSH 1 ; PUSH 2 ; ADD ; PUSH 3 ; MUL ; PUSH 4 ; SUB
+    assert [PUSH(5)] == optimize(op_compiler("SSSTL;SSSTSL;TSSS;SSSTTL;TSSL;"
+                                             "SSSTSSL;TSST"))
+    # PUSH 1 ; PUSH 0 ; DIV
+    assert 3 == len(optimize(op_compiler("SSSTL;SSSSL;TSTS")))
+    # PUSH 1 ; PUSH 7 ; STORE ; PUSH 1 ; RETRIEVE ; MARK 1 ; PUSH -1 ; ADD ;
+    # DUP ; JZ 2 ; JUMP 1 ; MARK 2 ; CALL 3 ; END ; MARK 3 ; CALL 4 ; RET ;
+    # MARK 4 ; PUSH 2 ; MUL ; RET
+    src = ("SSSTL;SSSTTTL;TTS;SSSTL;TTT;LSSTL;SSTTL;TSSS;SLS;LTSTSL;LSLTL;"
+           "LSSTSL;LSTTTL;LLL;LSSTTL;LSTTSSL;LTL;LSSTSSL;SSSTSL;TSSL;LTL")
+    ins = op_compiler(src, unbox=True)
+    expected = PYWSEngine(ins).run()
+    assert ([0], {1: 7}) == expected
+    for level in (1, 2):
+        opt = optimize(ins, level)
+        assert [STOREK(1, 7), LOADK(1), MARK(LABEL("T")), ADDI(-1),
+                DUPJZ(LABEL("TS"))] == opt[:5]
+        assert len(opt) < len(ins)
+        assert expected == PYWSEngine(opt).run()
+        assert expected == PYWSEngine(opt).run(debug=True)
+        assert expected == PYWSEngine(opt).run_native()
+    # CALL 1 ; RET ; PUSH 5 ; END ; MARK 1 ; RET, the top-level RET has
+    # no caller and falls through
+    ins = op_compiler("LSTTL;LTL;SSSTSTL;LLL;LSSTL;LTL", unbox=True)
+    assert ([5], {}) == PYWSEngine(optimize(ins, 0)).run() == \
+        PYWSEngine(optimize(ins, 2)).run()
+
+
+def test_bytecode():
+    # PUSH 1 ; PUSH 7 ; STORE ; PUSH 1 ; RETRIEVE ; MARK 1 ; PUSH -1 ; ADD ;
+    # DUP ; JZ 2 ; JUMP 1 ; MARK 2 ; CALL 3 ; END ; MARK 3 ; CALL 4 ; RET ;
+    # MARK 4 ; PUSH 2 ; MUL ; RET
+    src = ("SSSTL;SSSTTTL;TTS;SSSTL;TTT;LSSTL;SSTTL;TSSS;SLS;LTSTSL;LSLTL;"
+           "LSSTSL;LSTTTL;LLL;LSSTTL;LSTTSSL;LTL;LSSTSSL;SSSTSL;TSSL;LTL")
+    ins = op_compiler(src, unbox=True)
+    expected = PYWSEngine(ins).run()
+    for program in (ins, optimize(ins, 2)):
+        bc = encode(program)
+        assert program == bc.decode()
+        assert disassembler(program, ';') == disassembler(bc, ';')
+        assert expected == BytecodeEngine(bc).run()
+        assert expected == BytecodeEngine(bc).run(debug=True)
+    # a linked Program encodes like its source
+    assert encode(ins).decode() == encode(Program(ins)).decode()
+    assert expected == BytecodeEngine(encode(Program(ins))).run()
+    big = [PUSH(2 ** 70), PUSH(-2 ** 70), ADD()]
+    assert ([0], {}) == BytecodeEngine(encode(big)).run()
+    # resumable like PYWSEngine
+    engine = BytecodeEngine(encode(ins))
+    while engine.run(max_steps=5) == EXHAUSTED:
+        pass
+    assert expected == (engine.stack, engine.heap)
+    assert engine.steps > 5
+    # reading waits for a FeedSource, and runs again once fed
+    source = FeedSource()
+    engine = BytecodeEngine(encode(op_compiler("SSSTL;TLTT", unbox=True)),
+                            input=source)
+    assert BLOCKED == engine.run(max_steps=10)
+    source.feed('12\n')
+    assert FINISHED == engine.run(max_steps=10)
+    assert ([], {1: 12}) == (engine.stack, engine.heap)
+    assert big == encode(big).decode()
+
+
+def test_cache(tmp_path):
+    settings = dict(cache.settings)
+    cache.configure(directory=str(tmp_path), enabled=True)
+    try:
+        src = "SSSTL;SSSTTL;TSSS"
+        assert [] == os.listdir(str(tmp_path))
+        ins = op_compiler(src, unbox=True, opt=1)
+        assert 1 == len(os.listdir(str(tmp_path)))
+        assert ins == op_compiler(src, unbox=True, opt=1) == [PUSH(4)]
+        assert 1 == len(os.listdir(str(tmp_path)))
+        assembler("PUSH 10")
+        assert 2 == len(os.listdir(str(tmp_path)))
+        cache.configure(max_size=0)
+        op_compiler("TSSS")
+        assert [] == os.listdir(str(tmp_path))
+        # an entry pickled by code which is gone is a miss
+        cache.configure(max_size=1 << 20)
+        ins = op_compiler(src)
+        name, = os.listdir(str(tmp_path))
+        with open(os.path.join(str(tmp_path), name), 'wb') as f:
+            f.write(b'cnot_a_module\nOP\n.')
+        assert ins == op_compiler(src)
+    finally:
+        cache.settings.update(settings)
+
+
+def test_reader(tmp_path):
+    assert 'SL' == Reader('a s\n', style.ORIGIN).code
+    assert 'as' == Reader('a s\n', style.ORIGIN).doc
+    assert 'TSL' == Reader('泥x草马', style.GMH).code
+    assert 'x' == Reader('泥x草马', style.GMH).doc
+    assert 'SL' == Reader(b'aSsL;\n', style.STL).code
+    path = tmp_path / 'prog.ws'
+    path.write_text('a\t草 \n' * 3, encoding='utf-8')
+    assert 'TSL' * 3 == Reader(str(path), style.ORIGIN).code
+    assert '草' * 3 == Reader(str(path), style.ORIGIN).doc.replace('a', '')
+
+
+def test_lexer():
+    assert [PUSH, NUMBER("STS"), DUP, END] == Lexer(Reader("SSSTSL;SLS;LLL"),
+                                                   strict=True).ins
+    # truncated literal, unfinished IMP, no END, invalid instruction
+    for src, strict in (("SSSTS", True), ("TSL", True), ("SLS", True),
+                        ("STTSLS", False)):
+        try:
+            Lexer(Reader(src), strict)
+            assert False
+        except SyntaxError:
+            pass
+    assert [PUSH] == Lexer(Reader("SSSTS")).ins
+
+
+def test_streaming(tmp_path, monkeypatch):
+    import wslexer
+    monkeypatch.setattr(wslexer, 'CHUNK', 3)
+    src = "SSSTSTTL;SLS;LSSTTL;TLST;LLL"
+    path = tmp_path / 'prog.ws'
+    path.write_text(src)
+    expected = [PUSH(NUMBER("STSTT")), DUP(), MARK(LABEL("TT"))]
+    assert expected == list(iter_ops(str(path)))[:3]
+    tokens = Lexer(Reader(str(path)), strict=True, lazy=True)
+    assert tokens.ins is None
+    assert PUSH is next(iter(tokens))
+    out = tmp_path / 'prog.wsir'
+    ir_compiler(str(path), out=str(out))
+    assert ir_compiler(src) + '\n' == out.read_text()
+    assert "PUSH 11\nDUP\nMARK 03\nPNUM\nEND" == ir_compiler(src)
+
+
+def test_output(tmp_path):
+    # PUSH 72 ; PCHR ; PUSH 105 ; PCHR ; PUSH -7 ; PNUM ; END
+    src = "SSSTSSTSSSL;TLSS;SSSTTSTSSTL;TLSS;SSTTTTL;TLST;LLL"
+    ins = op_compiler(src, unbox=True)
+    for run in (lambda e: e.run(), lambda e: e.run(debug=True),
+                lambda e: e.run_native()):
+        out = io.StringIO()
+        run(PYWSEngine(ins, output=out))
+        assert "Hi-7" == out.getvalue()
+    out = io.BytesIO()
+    BytecodeEngine(encode(ins), output=out).run()
+    assert b"Hi-7" == out.getvalue()
+    with open(str(tmp_path / 'out'), 'wb') as f:
+        PYWSEngine(ins, output=f.fileno()).run()
+    assert "Hi-7" == (tmp_path / 'out').read_text()
+    sink = OutputSink(io.StringIO(), buffer_size=3)
+    sink.write("ab")
+    assert "" == sink.target.getvalue()
+    sink.write("c")
+    assert "abc" == sink.target.getvalue()
+
+
+def test_input(monkeypatch):
+    # MARK 0 ; PUSH 0 ; RCHR ; PUSH 0 ; RETRIEVE ; DUP ; PCHR ;
+    # PUSH 10 ; SUB ; JZ 1 ; JUMP 0 ; MARK 1 ; PUSH 1 ; RNUM ; END
+    src = ("LSSSL;SSSSL;TLTS;SSSSL;TTT;SLS;TLSS;SSSTSTSL;TSST;LTSTL;LSLSL;"
+           "LSSTL;SSSTL;TLTT;LLL")
+    ins = op_compiler(src, unbox=True)
+    text = 'héllo, 世界\n-42\n'
+    for source in (text, text.encode('utf-8'), io.BytesIO(text.encode())):
+        for run in (lambda e: e.run(), lambda e: e.run(debug=True)):
+            out = io.StringIO()
+            stack, heap = run(PYWSEngine(ins, output=out, input=source))
+            assert 'héllo, 世界\n' == out.getvalue()
+            assert -42 == heap[1]
+            if isinstance(source, io.BytesIO):
+                source.seek(0)
+    # engines on stdin take turns, none loses what another read ahead
+    monkeypatch.setattr('sys.stdin', io.StringIO('ab\n12\n'))
+    # PUSH 0 ; RCHR
+    read = op_compiler("SSSSL;TLTS", unbox=True)
+    assert ord('a') == PYWSEngine(read).run()[1][0]
+    assert ord('b') == PYWSEngine(read).run()[1][0]
+    assert ord('\n') == PYWSEngine(read, input=sys.stdin).run()[1][0]
+    assert 12 == PYWSEngine(ins[-3:]).run()[1][1]
+    source = InputSource(io.BytesIO(text.encode()), block_size=1)
+    assert [ord(c) for c in 'héllo, 世界\n'] == [source.read_char()
+                                                for _ in range(10)]
+    assert -42 == source.read_number()
+    try:
+        source.read_char()
+        assert False
+    except EOFError:
+        pass
+    # an invalid byte is replaced alone
+    source = InputSource(b'\xe0AB\xff\xc3\xa9\xe4\xb8')
+    assert [0xFFFD, ord('A'), ord('B'), 0xFFFD, ord('\xe9'), 0xFFFD,
+            0xFFFD] == [source.read_char() for _ in range(7)]
+
+
+def test_heap():
+    heap = Heap()
+    heap[3] = 'a'
+    heap[NUMBER("STS")] = 'b'
+    heap[-1] = 'c'
+    heap[10 ** 9] = 'd'
+    heap['x'] = 'e'
+    assert {3: 'a', 2: 'b', -1: 'c', 10 ** 9: 'd', 'x': 'e'} == heap
+    assert 'b' == heap[2] == heap[NUMBER("STS")]
+    assert 5 == len(heap)
+    assert 2 not in Heap()
+    del heap[3]
+    assert 3 not in heap and 4 == len(heap)
+    assert heap == copy.deepcopy(heap) == pickle.loads(pickle.dumps(heap))
+    assert 0 < heap.memory_usage()
+    # the dense region takes over sparse keys when it grows
+    heap[100] = 'f'
+    for i in range(200):
+        heap[i] = i
+    assert 100 == heap[100] and 100 not in heap.sparse
+    assert "-1 => 255 ('ÿ')" in dump_heap(Heap({-1: 255}))
+    stack, heap = ws_run("SSSTL;SSSTSL;TTS;SSSTL;TTT")
+    assert isinstance(heap, Heap) and [2] == stack
+
+
+def test_int64():
+    stack = IntStack([1, 2])
+    assert [1, 2] == stack and [1, 2] == copy.deepcopy(stack)
+    assert isinstance(pickle.loads(pickle.dumps(stack)), IntStack)
+    ins = [PUSH(3), SWAP(), COPY(1), ADD(), END()]
+    engine = PYWSEngine(ins, stack=[7], int64=True)
+    stack, _ = engine.run()
+    assert isinstance(stack, IntStack) and [3, 10] == stack
+    # overflow promotes the stack to a list, and the result is exact
+    big = [PUSH(2 ** 62), DUP(), MUL(), PUSH(1), ADD(), END()]
+    for debug in (False, True):
+        stack, _ = PYWSEngine(big, int64=True).run(debug=debug)
+        assert [2 ** 124 + 1] == stack and isinstance(stack, list)
+    try:
+        PYWSEngine(big, int64=True, trap=True).run()
+        assert False
+    except OverflowError:
+        pass
+    # a foreign result is promoted without calling the function again
+    ins = [PUSH(2 ** 40), PUSH(2 ** 40), PYFN(LABEL("ST")), PUSH(1), ADD()]
+    assert [2 ** 80 + 1] == PYWSEngine(ins, int64=True).run()[0]
+    # native code traps, a foreign result too
+    try:
+        PYWSEngine(ins, int64=True).run_native()
+        assert False
+    except OverflowError:
+        pass
+    # only a refused store promotes, other overflows are the program's
+    for debug in (False, True):
+        out = io.StringIO()
+        engine = PYWSEngine([PUSH(65), PUSH(2 ** 40), PCHR(), END()],
+                            output=out, int64=True)
+        try:
+            engine.run(debug=debug)
+            assert False
+        except OverflowError:
+            assert '' == out.getvalue()
+    calls = []
+    label = LABEL("TTTTSTSTS")
+
+    def overflow():
+        calls.append(1)
+        raise OverflowError
+
+    PYFN_MAP[label] = overflow
+    try:
+        PYWSEngine([PYFN(label)], int64=True).run()
+        assert False
+    except OverflowError:
+        assert [1] == calls
+    finally:
+        del PYFN_MAP[label]
+    # a short stack fails the same way in every mode
+    for int64 in (False, True):
+        try:
+            PYWSEngine([SWAP()], stack=[1], int64=int64).run()
+            assert False
+        except IndexError:
+            pass
+
+
+def test_skip():
+    assert 'SKIP 2' == repr(SKIP(2)) and SKIP(1) != SKIP(2)
+    # slide the items right under the top, not from the bottom
+    for n, expect in ((0, [1, 2, 3, 4]), (2, [1, 4]), (9, [4])):
+        ins = [PUSH(1), PUSH(2), PUSH(3), PUSH(4), SKIP(n), END()]
+        assert expect == PYWSEngine(ins).run()[0]
+        assert expect == PYWSEngine(ins).run(debug=True)[0]
+        assert expect == PYWSEngine(ins, int64=True).run()[0]
+        assert expect == PYWSEngine(ins).run_native()[0]
+        assert expect == BytecodeEngine(encode(ins)).run()[0]
+    # the items right under the top of a deep stack, in every mode
+    deep = list(range(100000))
+    ins = [SKIP(1)] * 2000 + [SKIP(3)]
+    expect = deep[:-2004] + deep[-1:]
+    assert expect == PYWSEngine(ins, stack=deep).run()[0]
+    assert expect == PYWSEngine(ins, stack=deep).run(debug=True)[0]
+    assert expect == PYWSEngine(ins, stack=deep).run_native()[0]
+    assert expect == BytecodeEngine(encode(ins), stack=deep).run()[0]
+    # there is no top to keep on an empty stack, as ever
+    for n in (0, 2):
+        for run in (lambda e: e.run(), lambda e: e.run(debug=True),
+                    lambda e: e.run_native()):
+            try:
+                run(PYWSEngine([SKIP(n)]))
+                assert False
+            except IndexError:
+                pass
+        try:
+            BytecodeEngine(encode([SKIP(n)])).run()
+            assert False
+        except IndexError:
+            pass
+
+
+def test_trace(tmp_path):
+    # read n, then count it down, storing each count in the heap
+    ins = [PUSH(0), RNUM(), PUSH(0), RETRIEVE(), MARK(LABEL("SS")),
+           DUP(), JZ(LABEL("ST")), DUP(), DUP(), STORE(), PUSH(7), SWAP(),
+           SKIP(1),
+           ADDI(-1), CALL(LABEL("TS")), JUMP(LABEL("SS")), MARK(LABEL("ST")),
+           END(), MARK(LABEL("TS")), PUSH(1), POP(), RET()]
+    # a checkpoint at every step is the full copy of the old history
+    full = Trace(interval=1)
+    PYWSEngine(ins, input=b"30\n").run(traceall=full)
+    path = str(tmp_path / 'run.trace')
+    engine = PYWSEngine(ins, input=b"30\n")
+    engine.run(traceall=Trace(interval=7, out=path))
+    engine.history.close()
+    trace = engine.history
+    assert len(full) == len(trace) > 200
+    assert list(full) == list(trace) == list(wstrace.load(path))
+    assert (engine.stack, engine.heap) == tuple(trace[-1][2:])
+    assert [30] == trace[4][2] and {0: 30} == trace[4][3]
+    ring = Trace(interval=10, ring=50, out=io.BytesIO())
+    PYWSEngine(ins, input=b"30\n").run(traceall=ring)
+    assert len(ring.deltas) <= 60 and ring.base > 0
+    assert list(full)[ring.base:] == list(ring)
+    try:
+        ring[0]
+        assert False
+    except IndexError:
+        pass
+    # without checkpoints, a ring still trims
+    ring = Trace(interval=0, ring=20)
+    PYWSEngine(ins, input=b"30\n").run(traceall=ring)
+    assert len(ring.deltas) <= 40 and len(ring.checkpoints) <= 3
+    assert list(full)[ring.base:] == list(ring)
+    # a PYFN may return a LABEL
+    label = LABEL("TTTTSTSTT")
+    PYFN_MAP[label] = lambda: LABEL("ST")
+    try:
+        engine = PYWSEngine([PYFN(label)])
+        engine.run(traceall=Trace(interval=0, out=path))
+        engine.history.close()
+        top, = wstrace.load(path)[-1][2]
+        assert isinstance(top, LABEL) and '01' == top.literal
+    finally:
+        del PYFN_MAP[label]
+
+
+def test_profile(tmp_path):
+    # CALL 1 ; END ; MARK 1 ; count 3 down in MARK 2 ; MARK 3 ; RET
+    ins = [PUSH(3), CALL(LABEL("T")), END(), MARK(LABEL("T")), PUSH(0),
+           POP(), MARK(LABEL("TS")), DUP(), JZ(LABEL("TT")), ADDI(-1),
+           JUMP(LABEL("TS")), MARK(LABEL("TT")), POP(), RET()]
+    ticks = iter(range(1 << 20))
+    engine = PYWSEngine(ins)
+    # every step takes one second
+    profile = Profile(engine, clock=lambda: float(next(ticks)))
+    assert ([], {}) == engine.run_profiled(profile)
+    assert profile is engine.profile
+    assert 21 == sum(profile.counts)
+    rows = {row[0]: row[1:] for row in profile.rows('region')}
+    assert (3, 0, 3.0) == rows['<main>'][:3]
+    assert (2, 1, 2.0) == rows['MARK 1'][:3]
+    assert (14, 0, 14.0, 14.0) == rows['MARK 2']
+    assert rows['MARK 1'][3] > 18
+    ops = {row[0]: row[1] for row in profile.rows('op')}
+    assert 4 == ops['DUP'] and 1 == ops['CALL']
+    table = profile.table(sort='steps').splitlines()
+    assert table[1].endswith('MARK 2') and 'total' in table[0]
+    assert '<main>;MARK 1;MARK 2 14000000' in profile.collapsed()
+    path = str(tmp_path / 'run.prof')
+    profile.dump_stats(path)
+    stats = pstats.Stats(path)
+    assert 1 == stats.stats[('<ws>', 3, 'MARK 1')][0]
+    assert PYWSEngine(ins).run() == PYWSEngine(ins).run_profiled()
+
+
+def test_benchmarks(tmp_path):
+    report = suite.run_suite(repeat=1, scale=0.05)
+    assert sorted(PROGRAMS) == sorted(report['results'])
+    for stages in report['results'].values():
+        assert set(suite.STAGES) == set(stages)
+    path = str(tmp_path / 'baseline.json')
+    suite.save(report, path)
+    rows = suite.compare(report, suite.load(path))
+    assert len(rows) == 2 * len(PROGRAMS) * len(suite.STAGES)
+    assert not any(row[-1] for row in rows)
+    slower = copy.deepcopy(report)
+    slower['results']['loop']['run']['time'] *= 2
+    assert [('loop', 'run', 'time')] == [
+        row[:3] for row in suite.compare(slower, report) if row[-1]]
+    # the assembled IR and the compiled source run the same
+    prog = build('hanoi', 0.3)
+    code, ins = assembler(prog.ir, sep='', unbox=True)
+    assert op_compiler(code, unbox=True) == ins
+
+
+def test_batch(tmp_path):
+    echo = build('echo', 0.001).ir
+    loop = "LSSSL;LSLSL"
+    inputs = []
+    for i in range(5):
+        path = str(tmp_path / 'in{}.txt'.format(i))
+        with open(path, 'w') as f:
+            f.write('job {}\n$'.format(i))
+        inputs.append(path)
+    programs = batch.compile_programs([echo], assemble=True)
+    programs.update(batch.compile_programs([loop, loop]))
+    jobs = [(echo, path) for path in inputs] + [(loop, None), (echo, 'nil')]
+    for workers in (0, 2):
+        results = list(batch.run_batch(jobs, programs, workers, chunksize=2,
+                                       max_steps=1000))
+        assert list(range(7)) == [r['job'] for r in results]
+        for i, result in enumerate(results[:5]):
+            assert 'ok' == result['status']
+            assert 'job {}\n'.format(i) == result['stdout']
+            assert [] == result['stack'] and {'0': 36} == result['heap']
+        assert ('step_limit', 1000) == (results[5]['status'],
+                                        results[5]['steps'])
+        assert 'error' == results[6]['status']
+    result, = batch.run_batch([(loop, None)], programs, 0, timeout=0.05)
+    assert 'time_limit' == result['status']
+    engine = PYWSEngine(op_compiler("SSSTL;SSSTSL;TSSS;LLL"))
+    assert not engine.run_steps(2) and 2 == engine.steps
+    assert engine.run_steps(5) and 4 == engine.steps
+    assert [3] == engine.stack
+
+
+@wsfunction()
+def countdown(n):
+    """LSSSL;SLS;LTSTL;SSTTL;TSSS;LSLSL;LSSTL"""
+
+
+def test_program():
+    # MARK 0 ; DUP ; JZ 1 ; PUSH -1 ; ADD ; JUMP 0 ; MARK 1
+    src = "LSSSL;SLS;LTSTL;SSTTL;TSSS;LSLSL;LSSTL"
+    program = Program(op_compiler(src), source=src)
+    assert 5 == len(program) and {LABEL("S"): 0, LABEL("T"): 5} == \
+        dict(program.labels)
+    assert src == program.meta['source']
+    for name in ('ins', 'labels', 'extra'):
+        try:
+            setattr(program, name, None)
+            assert False
+        except AttributeError:
+            pass
+    assert program == pickle.loads(pickle.dumps(program))
+    assert program == Program(program)
+    engine = PYWSEngine(program, stack=[3])
+    assert program.ins is engine.ins
+    code = engine.thread()
+    engine.code = code
+    assert ([0], {}) == engine.run()
+    engine.reset([5], {1: 2})
+    assert ([0], {1: 2}) == engine.run_threaded()
+    assert code is engine.code
+    assert ([0], {}) == PYWSEngine(program, stack=[2]).run_native()
+    assert program.native() is program.native()
+    results = []
+
+    def work(n):
+        results.append(PYWSEngine(program, stack=[n]).run())
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [([0], {})] * 8 == results
+    # engines are reused by later calls, and by calls from many threads
+    assert 0 == countdown(7) == countdown(3)
+    assert isinstance(countdown.program, Program)
+    threads = [threading.Thread(target=lambda: results.append(countdown(50)))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [0] * 4 == results[8:]
+    assert 3 == add(1, 2) == add(2, 1)
+    # PUSH 3 ; PUSH 4 ; PYFN 3, wsadd calls again while running
+    assert 7 == ws_run("SSSTTL;SSSTSSL;LLSTTL")[0].pop()
+
+
+@wsfunction(stack_only=True)
+def swap_dup(x, y):
+    """SLTSLS"""
+
+
+def test_map():
+    rows = [(i, i * 3) for i in range(3000)]
+    expected = [a + b for a, b in rows]
+    # one chunk runs in this thread
+    assert expected[:10] == list(add.starmap(rows[:10]))
+    for executor in ('thread', 'process'):
+        assert expected == list(add.starmap(rows, workers=2, chunksize=256,
+                                            executor=executor))
+    with ThreadPoolExecutor(2) as pool:
+        assert [0] * 700 == list(countdown.map(range(700), chunksize=100,
+                                               executor=pool))
+    stacks = list(swap_dup.starmap(rows[:300], chunksize=64,
+                                   executor='thread'))
+    assert [[b, a, a] for a, b in rows[:300]] == stacks
+    assert 4 == len(set(map(id, stacks[:4])))
+    results = countdown.map(itertools.count(), chunksize=8,
+                            executor='thread', workers=2)
+    assert [0] * 100 == list(itertools.islice(results, 100))
+    results.close()
+
+
+# how many steps n takes to get to 1 in the collatz sequence
+@wsfunction()
+def collatz(n):
+    """
+    SS;SSL;SS;SSL;TTS;LSS;SL;SLS;SS;STL;TSST;LTS;TL;SLS;SS;STSL;TSTT;LTS;TSL;
+    SS;STTL;TSSL;SS;STL;TSSS;LSL;TTL;LSS;TSL;SS;STSL;TSTS;LSS;TTL;SS;SSL;
+    SS;SSL;TTT;SS;STL;TSSS;TTS;LSL;SL;LSS;TL;SLL;SS;SSL;TTT
+    """
+
+
+def test_vector():
+    pytest.importorskip('numpy')
+    from vector import VectorEngine
+    rows = [(n,) for n in range(1, 200)]
+    # data dependent loops and branches
+    expected = [collatz(*row) for row in rows]
+    assert expected[:9] == [0, 1, 7, 2, 5, 8, 16, 3, 19]
+    assert expected == list(collatz.starmap(rows, chunksize=64,
+                                            executor='vector'))
+    assert [add(*row) for row in [(1, 2)] * 5] == list(
+        add.starmap([(1, 2)] * 5, executor='vector'))
+    for name in PROGRAMS:
+        prog = build(name, 0.05)
+        _, ins = assembler(prog.ir, unbox=True)
+        engine = VectorEngine(ins, [[]] * 3, inputs=[prog.input] * 3)
+        expected = PYWSEngine(ins, output=io.StringIO(), input=prog.input)
+        assert [expected.run()] * 3 == engine.run()
+        assert [prog.output] * 3 == engine.outputs
+    # overflows and big ints fall back to the scalar engine
+    fib = build('fibonacci', 1).ir
+    _, ins = assembler(fib, unbox=True)
+    engine = VectorEngine(ins, [[]] * 2)
+    assert [PYWSEngine(ins, output=io.StringIO()).run()] * 2 == engine.run()
+    assert engine.outputs[0].endswith(
+        '137347080577163115432025771710279131845700275212767467264610201\n')
+    square = op_compiler("SLS;TSSL")
+    big = [(2 ** 40,), (3,), (2 ** 70,), (-2 ** 31,)]
+    assert [([n * n], {}) for n, in big] == VectorEngine(square, big).run()
+    try:
+        VectorEngine(op_compiler("TSTS"), [(1, 0)]).run()
+        assert False
+    except ZeroDivisionError:
+        pass
+
+
+class Collect(object):
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def test_async():
+    echo, loop = build('echo', 0.01), build('loop', 0.5)
+    echo_ins = assembler(echo.ir, unbox=True)[1]
+
+    async def main():
+        reader, out = asyncio.StreamReader(), Collect()
+        session = AsyncPYWSEngine(echo_ins, output=out, input=reader)
+        busy = AsyncPYWSEngine(assembler(loop.ir, unbox=True)[1],
+                               output=Collect(), quantum=100)
+        task = asyncio.ensure_future(busy.run_async())
+        waiting = asyncio.ensure_future(session.run_async())
+        await asyncio.sleep(0)
+        # the session waits for input, and the loop goes on meanwhile
+        assert not waiting.done() and not task.done()
+        for part in (echo.input[:5], echo.input[5:]):
+            reader.feed_data(part)
+            await asyncio.sleep(0)
+        await waiting
+        assert echo.output == out.data.decode() and not task.done()
+        await task
+        assert loop.output == busy.output.target.data.decode()
+        # the base run still works, for a Scheduler
+        sched = Scheduler()
+        task = sched.add(AsyncPYWSEngine(assembler(loop.ir, unbox=True)[1],
+                                         output=Collect()))
+        sched.run()
+        assert FINISHED == task.status
+        # a session per connection
+        server = await serve(echo_ins, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def client(text):
+            r, w = await asyncio.open_connection('127.0.0.1', port)
+            w.write(text.encode() + b'$')
+            return (await r.read()).decode()
+
+        texts = ['client {}\n'.format(i) for i in range(20)]
+        assert texts == await asyncio.gather(*map(client, texts))
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_scheduler():
+    echo = build('echo', 0.01)
+    echo_ins = assembler(echo.ir, unbox=True)[1]
+    # MARK 0 ; JUMP 0
+    forever = op_compiler("LSSSL;LSLSL")
+    source = FeedSource()
+    engine = PYWSEngine(echo_ins, output=io.StringIO(), input=source)
+    assert BLOCKED == engine.run(max_steps=100)
+    source.feed(echo.input[:3])
+    assert EXHAUSTED == engine.run(max_steps=2)
+    now = [0.0]
+    sched = Scheduler(quantum=10, clock=lambda: now[0])
+    session = sched.add(engine, 'echo', priority=10)
+    low = sched.add(forever, 'low', max_steps=1000)
+    high = sched.add(forever, 'high', priority=3, timeout=5)
+    broken = sched.add(op_compiler("SSSTL;SSSSL;TSTS"), 'broken')
+    assert 4 == sched.step()
+    assert (10, 30) == (low.engine.steps, high.engine.steps)
+    assert scheduler.ERROR == broken.status and \
+        isinstance(broken.error, ZeroDivisionError)
+    assert BLOCKED == session.status and not session.runnable
+    now[0] = 5
+    sched.run()
+    assert scheduler.TIME_LIMIT == high.status
+    assert scheduler.STEP_LIMIT == low.status and 1000 == low.engine.steps
+    source.feed(echo.input[3:])
+    sched.run()
+    assert FINISHED == session.status and all(
+        t.done for t in sched.tasks)
+    engine.output.flush()
+    assert echo.output == engine.output.target.getvalue()
+
+
+def test_snapshot():
+    for name in ('hanoi', 'sort', 'recursion'):
+        prog = build(name, 0.2)
+        program = Program(assembler(prog.ir)[1])
+        engine = PYWSEngine(program, output=io.StringIO())
+        out = []
+        while engine.run(max_steps=97) != FINISHED:
+            blob = snapshot.dump(engine)
+            out.append(engine.output.target.getvalue())
+            engine = snapshot.load(blob, {program.digest(): program},
+                                   output=io.StringIO())
+        out.append(engine.output.target.getvalue())
+        assert prog.output == ''.join(out)
+    # the unread input goes with the snapshot, the rest is read from input
+    echo = build('echo', 0.01)
+    program = Program(assembler(echo.ir, unbox=True)[1])
+    source = FeedSource()
+    source.feed(echo.input[:7])
+    engine = PYWSEngine(program, output=io.StringIO(), input=source,
+                        int64=True)
+    assert EXHAUSTED == engine.run(max_steps=20)
+    blob = snapshot.dump(engine)
+    assert len(blob) < 64
+    engine = snapshot.load(blob, program, output=io.StringIO(),
+                           input=echo.input[7:])
+    assert isinstance(engine.stack, IntStack) and 20 == engine.steps
+    engine.run()
+    assert echo.output[2:] == engine.output.target.getvalue()
+    try:
+        snapshot.load(blob, Program(op_compiler("SSSTL")))
+        assert False
+    except ValueError:
+        pass
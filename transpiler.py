@@ -0,0 +1,232 @@
+# encoding=utf-8
+"""
+Translate a list of WSOperations into one native Python function.
+
+The linked program is cut into basic blocks at every jump target and after
+every flow operation, each block becomes a branch of a `while` loop which
+dispatches on the block number through a binary tree of `if`s.
+Inside a block, the stack is simulated at compile time: pushed values are
+kept in local variables (or constants) and only written back to the real
+stack at the end of the block, or before any operation needing it.
+"""
+import itertools
+
+from wsbuiltin import PUSH, POP, DUP, COPY, SKIP, SWAP
+from wsbuiltin import STORE, RETRIEVE
+from wsbuiltin import ADD, SUB, MUL, DIV, MOD
+from wsbuiltin import JumpOperation, CALL, JUMP, JZ, JS, RET, END
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ
+from wsbuiltin import PCHR, PNUM
+from linker import link
+
+# WhiteSpace arithmetic is `second OP top`
+BINARY = {ADD: '+', SUB: '-', MUL: '*', DIV: '//', MOD: '%'}
+BRANCH = {JZ: '==', JS: '<'}
+BLOCK_END = (CALL, JUMP, JZ, JS, DUPJZ, RET, END)
+
+
+class BlockWriter(object):
+    """
+    Emit the body of one basic block, simulating the stack
+    """
+
+    def __init__(self, names):
+        self.lines = []
+        self.vstack = []
+        self.names = names
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def temp(self, expr):
+        name = 't{}'.format(next(self.names))
+        self.emit('{} = {}'.format(name, expr))
+        return name
+
+    def need(self, n):
+        """
+        Make sure the top n items are in the simulated stack
+        """
+        while len(self.vstack) < n:
+            self.vstack.insert(0, self.temp('pop()'))
+
+    def pop(self):
+        self.need(1)
+        return self.vstack.pop()
+
+    def flush(self):
+        """
+        Write simulated items back to the real stack
+        """
+        if len(self.vstack) == 1:
+            self.emit('push({})'.format(self.vstack[0]))
+        elif self.vstack:
+            self.emit('stack.extend(({},))'.format(', '.join(self.vstack)))
+        self.vstack = []
+
+    def goto(self, block):
+        self.emit('block = {}'.format(block))
+        self.emit('continue')
+
+
+def split_blocks(ins):
+    """
+    Give linked instructions, return the leader pc of every basic block,
+    and the block starting at each jump target
+    """
+    leaders = {0}
+    for pc, op in enumerate(ins):
+        if isinstance(op, JumpOperation):
+            leaders.add(op.target)
+        if isinstance(op, BLOCK_END):
+            leaders.add(pc + 1)
+    leaders = sorted(pc for pc in leaders if pc < len(ins)) or [0]
+    blocks = {pc: i for i, pc in enumerate(leaders)}
+    # jumping to the very end goes to the final, returning block
+    blocks[len(ins)] = len(leaders)
+    return leaders, blocks
+
+
+def write_block(ins, start, stop, index, blocks, names):
+    w = BlockWriter(names)
+    for pc in range(start, stop):
+        op = ins[pc]
+        cls = type(op)
+        if cls is PUSH:
+            w.vstack.append(repr(int(op.val)))
+        elif cls is POP:
+            if w.vstack:
+                w.vstack.pop()
+            else:
+                w.emit('pop()')
+        elif cls is DUP:
+            if w.vstack:
+                w.vstack.append(w.vstack[-1])
+            else:
+                w.vstack.append(w.temp('stack[-1]'))
+        elif cls is COPY:
+            n = int(op.index)
+            if n < len(w.vstack):
+                w.vstack.append(w.vstack[-1 - n])
+            else:
+                w.vstack.append(w.temp('stack[{}]'.format(
+                    -1 - n + len(w.vstack))))
+        elif cls is SKIP:
+            top = w.pop()
+            n = int(op.n)
+            dropped = min(n, len(w.vstack))
+            del w.vstack[len(w.vstack) - dropped:]
+            if n > dropped:
+                w.flush()
+                w.emit('del stack[-{}:]'.format(n - dropped))
+            w.vstack.append(top)
+        elif cls is SWAP:
+            w.need(2)
+            w.vstack[-1], w.vstack[-2] = w.vstack[-2], w.vstack[-1]
+        elif cls is STORE:
+            val = w.pop()
+            key = w.pop()
+            w.emit('heap[{}] = {}'.format(key, val))
+        elif cls is RETRIEVE:
+            w.vstack.append(w.temp('heap[{}]'.format(w.pop())))
+        elif cls in BINARY:
+            b = w.pop()
+            a = w.pop()
+            w.vstack.append(w.temp('{} {} {}'.format(a, BINARY[cls], b)))
+        elif cls is ADDI:
+            w.vstack.append(w.temp('{} + {!r}'.format(w.pop(), int(op.val))))
+        elif cls is LOADK:
+            w.vstack.append(w.temp('heap[{!r}]'.format(int(op.key))))
+        elif cls is STOREK:
+            w.emit('heap[{!r}] = {!r}'.format(int(op.key), int(op.val)))
+        elif cls is PCHR:
+            w.emit('write(chr({}))'.format(w.pop()))
+        elif cls is PNUM:
+            w.emit('write(str({}))'.format(w.pop()))
+        elif cls is DUPJZ:
+            top = w.pop()
+            w.vstack.append(top)
+            w.flush()
+            w.emit('if {} == 0:'.format(top))
+            w.emit('    block = {}'.format(blocks[op.target]))
+            w.emit('    continue')
+        elif cls in BRANCH:
+            top = w.pop()
+            w.flush()
+            w.emit('if {} {} 0:'.format(top, BRANCH[cls]))
+            w.emit('    block = {}'.format(blocks[op.target]))
+            w.emit('    continue')
+        elif cls in (JUMP, CALL):
+            w.flush()
+            if cls is CALL:
+                w.emit('calls.append({})'.format(index + 1))
+            w.goto(blocks[op.target])
+            return w.lines
+        elif cls is RET:
+            w.flush()
+            w.emit('if calls:')
+            w.emit('    block = calls.pop()')
+            w.emit('    continue')
+        elif cls is END:
+            w.flush()
+            w.emit('engine.end()')
+            w.emit('return')
+            return w.lines
+        else:
+            # IO, PYFN and others, run the operation itself
+            w.flush()
+            w.emit('OPS[{}](stack, heap, engine.labels, engine)'.format(pc))
+    w.flush()
+    w.goto(index + 1)
+    return w.lines
+
+
+def dispatch(bodies, lo, hi, indent):
+    """
+    Binary search tree of `if`s over block numbers lo..hi-1
+    """
+    pad = '    ' * indent
+    if hi - lo == 1:
+        return [pad + line for line in bodies[lo]]
+    mid = (lo + hi) // 2
+    return ([pad + 'if block < {}:'.format(mid)] +
+            dispatch(bodies, lo, mid, indent + 1) +
+            [pad + 'else:'] +
+            dispatch(bodies, mid, hi, indent + 1))
+
+
+def transpile(ins, name='ws_program'):
+    """
+    Give a list of WSOperations, return the Python source code of a function
+    running it on an engine
+    """
+    ins, _ = link(ins)
+    leaders, blocks = split_blocks(ins)
+    bounds = leaders + [len(ins)]
+    names = itertools.count()
+    bodies = [write_block(ins, bounds[i], bounds[i + 1], i, blocks, names)
+              for i in range(len(leaders))]
+    # falling off the last block ends the program
+    bodies.append(['return'])
+    src = ['def {}(engine):'.format(name),
+           '    stack = engine.stack',
+           '    heap = engine.heap',
+           '    calls = engine.call_stack',
+           '    push = stack.append',
+           '    pop = stack.pop',
+           '    write = engine.output.write',
+           '    block = 0',
+           '    while True:']
+    src.extend(dispatch(bodies, 0, len(bodies), 2))
+    return '\n'.join(src) + '\n'
+
+
+def load(ins):
+    """
+    Return the compiled native function of given WSOperations,
+    program.Program.native keeps it for the program
+    """
+    namespace = {'OPS': link(ins)[0]}
+    code = compile(transpile(ins), '<pyws-native>', 'exec')
+    exec(code, namespace)
+    return namespace['ws_program']
@@ -0,0 +1,378 @@
+# encoding=utf-8
+"""
+A lockstep engine running one program over many inputs at once, with NumPy.
+
+The runs, or lanes, are grouped into batches sharing a pc, a call stack and
+the shape of their stack and heap. Every stack item and heap cell of a
+batch is an int64 vector with an element per lane, so an operation runs
+once per batch instead of once per lane.
+
+A branch the lanes of a batch disagree on, or a heap address they disagree
+on, splits the batch; batches meeting again at a pc in the same shape are
+merged. The batch with the lowest pc always runs first, so the lanes left
+behind by a branch catch up where the paths join.
+
+Whatever a batch cannot run as int64 vectors (an overflow, a division by
+zero, reading input, PYFN) is run on to the end by PYWSEngine, lane by lane,
+so the results always match the scalar engine.
+
+Needs NumPy.
+"""
+import io
+
+import numpy as np
+
+from engine import PYWSEngine
+from memory import Heap, INT64_MIN, INT64_MAX
+from program import Program
+from wsbuiltin import PUSH, POP, DUP, COPY, SKIP, SWAP, STORE, RETRIEVE
+from wsbuiltin import ADD, SUB, MUL, DIV, MOD, PCHR, PNUM
+from wsbuiltin import CALL, JUMP, JZ, JS, RET, END
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ
+
+# returned by a handler when its batch is gone: split, ended or scalar
+STOP = -1
+
+
+def fits(val):
+    return type(val) is int and INT64_MIN <= val <= INT64_MAX
+
+
+def uniform(vec):
+    return bool((vec == vec[0]).all())
+
+
+class Batch(object):
+    """
+    Lanes at the same pc, with the same call stack and the same depth of
+    stack and heap addresses
+    """
+    __slots__ = ('lanes', 'pc', 'stack', 'heap', 'calls')
+
+    def __init__(self, lanes, pc, stack, heap, calls):
+        self.lanes = lanes
+        self.pc = pc
+        self.stack = stack
+        self.heap = heap
+        self.calls = calls
+
+    def shape(self):
+        return self.pc, len(self.stack), tuple(self.calls), \
+            frozenset(self.heap)
+
+    def take(self, mask):
+        """
+        The lanes of mask as a new batch
+        """
+        return Batch(self.lanes[mask], self.pc, [v[mask] for v in self.stack],
+                     {k: v[mask] for k, v in self.heap.items()},
+                     list(self.calls))
+
+    def merge(self, other):
+        self.lanes = np.concatenate((self.lanes, other.lanes))
+        self.stack = [np.concatenate(pair)
+                      for pair in zip(self.stack, other.stack)]
+        self.heap = {k: np.concatenate((v, other.heap[k]))
+                     for k, v in self.heap.items()}
+
+
+class VectorEngine(object):
+    """
+    Run ins, a program.Program or a list of WSOperations, on every stack in
+    stacks, and heaps (default: empty) at once.
+    inputs are for the lanes falling back to PYWSEngine, default: b''
+
+    run() returns [(stack, heap)] per lane like PYWSEngine.run, and the
+    output of each lane is in outputs.
+    """
+
+    def __init__(self, ins, stacks, heaps=None, inputs=None):
+        self.program = ins if isinstance(ins, Program) else Program(ins)
+        self.ins = self.program.ins
+        self.ins_len = len(self.ins)
+        stacks = [list(s) for s in stacks]
+        heaps = [dict(h or {}) for h in heaps] if heaps is not None else \
+            [{} for _ in stacks]
+        self.inputs = inputs if inputs is not None else [b''] * len(stacks)
+        self.parts = [[] for _ in stacks]
+        self.results = [None] * len(stacks)
+        self.handlers = [HANDLERS.get(type(op), VectorEngine.scalar)
+                         for op in self.ins]
+        self.batches = []
+        groups = {}
+        for lane, (stack, heap) in enumerate(zip(stacks, heaps)):
+            if all(map(fits, stack)) and all(map(fits, heap)) and \
+                    all(map(fits, heap.values())):
+                shape = len(stack), tuple(sorted(heap))
+                groups.setdefault(shape, []).append(lane)
+            else:
+                self.run_scalar(lane, 0, stack, heap, [])
+        for (depth, keys), lanes in groups.items():
+            stack = [np.array([stacks[lane][i] for lane in lanes],
+                              dtype=np.int64) for i in range(depth)]
+            heap = {k: np.array([heaps[lane][k] for lane in lanes],
+                                dtype=np.int64) for k in keys}
+            self.batches.append(Batch(np.array(lanes), 0, stack, heap, []))
+
+    @property
+    def outputs(self):
+        return [''.join(parts) for parts in self.parts]
+
+    def run(self):
+        batches, ins, handlers, end = self.batches, self.ins, self.handlers, \
+            self.ins_len
+        while batches:
+            batch = min(batches, key=lambda b: b.pc)
+            shape = batch.shape()
+            for other in [b for b in batches
+                          if b is not batch and b.pc == batch.pc]:
+                if other.shape() == shape:
+                    batch.merge(other)
+                    batches.remove(other)
+            # run until catching up with the next batch ahead
+            limit = min((b.pc for b in batches if b.pc > batch.pc),
+                        default=end)
+            pc = batch.pc
+            while pc < limit:
+                pc = handlers[pc](self, batch, ins[pc])
+                if pc == STOP:
+                    break
+                batch.pc = pc
+            else:
+                if pc >= end:
+                    self.finish(batch)
+        return self.results
+
+    def remove(self, batch):
+        self.batches.remove(batch)
+
+    def finish(self, batch):
+        """
+        The lanes of batch have ended
+        """
+        self.remove(batch)
+        columns = [v.tolist() for v in batch.stack]
+        cells = {k: v.tolist() for k, v in batch.heap.items()}
+        for i, lane in enumerate(batch.lanes.tolist()):
+            self.results[lane] = ([c[i] for c in columns],
+                                  Heap({k: v[i] for k, v in cells.items()}))
+        return STOP
+
+    def split(self, batch, vec):
+        """
+        Replace batch by a batch per value of vec
+        """
+        self.remove(batch)
+        for val in np.unique(vec):
+            self.batches.append(batch.take(vec == val))
+        return STOP
+
+    def branch(self, batch, cond, target):
+        """
+        Jump the lanes where cond holds, split if only some do
+        """
+        if cond.all():
+            return target
+        if not cond.any():
+            return batch.pc + 1
+        self.remove(batch)
+        taken, rest = batch.take(cond), batch.take(~cond)
+        taken.pc, rest.pc = target, batch.pc + 1
+        self.batches += [taken, rest]
+        return STOP
+
+    def scalar(self, batch, op=None):
+        """
+        Run the lanes of batch on PYWSEngine, from where they are
+        """
+        self.remove(batch)
+        columns = [v.tolist() for v in batch.stack]
+        cells = {k: v.tolist() for k, v in batch.heap.items()}
+        for i, lane in enumerate(batch.lanes.tolist()):
+            self.run_scalar(lane, batch.pc, [c[i] for c in columns],
+                            {k: v[i] for k, v in cells.items()}, batch.calls)
+        return STOP
+
+    def run_scalar(self, lane, pc, stack, heap, calls):
+        out = io.StringIO()
+        engine = PYWSEngine(self.program, stack=stack, heap=heap, output=out,
+                            input=self.inputs[lane])
+        engine.pc = pc
+        engine.call_stack.extend(calls)
+        self.results[lane] = engine.run_threaded()
+        self.parts[lane].append(out.getvalue())
+
+    def push(self, batch, val):
+        if not fits(int(val)):
+            return self.scalar(batch)
+        batch.stack.append(np.full(len(batch.lanes), int(val),
+                                   dtype=np.int64))
+        return batch.pc + 1
+
+    def arith(self, batch, op):
+        stack = batch.stack
+        r = compute(type(op), stack[-2], stack[-1])
+        if r is None:
+            return self.scalar(batch)
+        stack.pop()
+        stack[-1] = r
+        return batch.pc + 1
+
+
+def compute(cls, a, b):
+    """
+    a op b for the AlgebraOperation cls, None if any lane overflows int64
+    or divides by zero
+    """
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        if cls is ADD:
+            r = a + b
+            bad = ((a ^ r) & (b ^ r)) < 0
+        elif cls is SUB:
+            r = a - b
+            bad = ((a ^ b) & (a ^ r)) < 0
+        elif cls is MUL:
+            r = a * b
+            safe = np.where(a == 0, 1, a)
+            bad = (a != 0) & ((r // safe != b) |
+                              ((a == -1) & (b == INT64_MIN)))
+        else:
+            bad = (b == 0) | ((a == INT64_MIN) & (b == -1))
+            safe = np.where(bad, 1, b)
+            r = a // safe if cls is DIV else a % safe
+    if bad.any():
+        return None
+    return r
+
+
+def _push(engine, batch, op):
+    return engine.push(batch, op.val)
+
+
+def _pop(engine, batch, op):
+    batch.stack.pop()
+    return batch.pc + 1
+
+
+def _dup(engine, batch, op):
+    batch.stack.append(batch.stack[-1])
+    return batch.pc + 1
+
+
+def _copy(engine, batch, op):
+    batch.stack.append(batch.stack[-1 - int(op.index)])
+    return batch.pc + 1
+
+
+def _skip(engine, batch, op):
+    if not batch.stack:
+        # raises IndexError
+        return engine.scalar(batch)
+    if op.n > 0:
+        del batch.stack[-1 - int(op.n):-1]
+    return batch.pc + 1
+
+
+def _swap(engine, batch, op):
+    stack = batch.stack
+    stack[-1], stack[-2] = stack[-2], stack[-1]
+    return batch.pc + 1
+
+
+def _store(engine, batch, op):
+    keys = batch.stack[-2]
+    if not uniform(keys):
+        return engine.split(batch, keys)
+    val = batch.stack.pop()
+    batch.stack.pop()
+    batch.heap[int(keys[0])] = val
+    return batch.pc + 1
+
+
+def _retrieve(engine, batch, op):
+    keys = batch.stack[-1]
+    if not uniform(keys):
+        return engine.split(batch, keys)
+    batch.stack[-1] = batch.heap[int(keys[0])]
+    return batch.pc + 1
+
+
+def _addi(engine, batch, op):
+    val = int(op.val)
+    r = None
+    if fits(val):
+        r = compute(ADD, batch.stack[-1],
+                    np.full(len(batch.lanes), val, dtype=np.int64))
+    if r is None:
+        return engine.scalar(batch)
+    batch.stack[-1] = r
+    return batch.pc + 1
+
+
+def _loadk(engine, batch, op):
+    batch.stack.append(batch.heap[int(op.key)])
+    return batch.pc + 1
+
+
+def _storek(engine, batch, op):
+    if not fits(int(op.val)):
+        return engine.scalar(batch)
+    batch.heap[int(op.key)] = np.full(len(batch.lanes), int(op.val),
+                                      dtype=np.int64)
+    return batch.pc + 1
+
+
+def _pchr(engine, batch, op):
+    vals = batch.stack.pop().tolist()
+    parts = engine.parts
+    for lane, val in zip(batch.lanes.tolist(), vals):
+        parts[lane].append(chr(val))
+    return batch.pc + 1
+
+
+def _pnum(engine, batch, op):
+    vals = batch.stack.pop().tolist()
+    parts = engine.parts
+    for lane, val in zip(batch.lanes.tolist(), vals):
+        parts[lane].append(str(val))
+    return batch.pc + 1
+
+
+def _call(engine, batch, op):
+    batch.calls.append(batch.pc)
+    return op.target
+
+
+def _jump(engine, batch, op):
+    return op.target
+
+
+def _jz(engine, batch, op):
+    return engine.branch(batch, batch.stack.pop() == 0, op.target)
+
+
+def _js(engine, batch, op):
+    return engine.branch(batch, batch.stack.pop() < 0, op.target)
+
+
+def _dupjz(engine, batch, op):
+    return engine.branch(batch, batch.stack[-1] == 0, op.target)
+
+
+def _ret(engine, batch, op):
+    if batch.calls:
+        return batch.calls.pop() + 1
+    return batch.pc + 1
+
+
+def _end(engine, batch, op):
+    return engine.finish(batch)
+
+
+HANDLERS = {PUSH: _push, POP: _pop, DUP: _dup, COPY: _copy, SKIP: _skip,
+            SWAP: _swap, STORE: _store, RETRIEVE: _retrieve,
+            ADD: VectorEngine.arith, SUB: VectorEngine.arith,
+            MUL: VectorEngine.arith, DIV: VectorEngine.arith,
+            MOD: VectorEngine.arith, PCHR: _pchr, PNUM: _pnum,
+            CALL: _call, JUMP: _jump, JZ: _jz, JS: _js, RET: _ret, END: _end,
+            ADDI: _addi, LOADK: _loadk, STOREK: _storek, DUPJZ: _dupjz}
@@ -0,0 +1,145 @@
+# encoding=utf-8
+"""
+An engine for asyncio, so one event loop runs many WhiteSpace programs.
+
+AsyncPYWSEngine.run_async runs the threaded code in slices of `quantum`
+steps, and gives the loop a turn between two slices, so a long loop never
+starves the others. RCHR and RNUM read from an asyncio.StreamReader (or
+anything with a coroutine read(n)): when the buffered input runs out, the
+read raises WouldBlock before touching the stack, the engine awaits more
+input and runs the same instruction again. The output goes to an
+asyncio.StreamWriter, drained at every turn.
+"""
+import asyncio
+import inspect
+
+from engine import PYWSEngine
+from program import Program
+from wsio import OutputSink, InputSource, FeedSource, WouldBlock, sink_of, \
+    source_of
+
+# steps run between two turns of the event loop
+QUANTUM = 10000
+
+
+class AsyncInputSource(FeedSource):
+    """
+    A wsio.FeedSource fed from a stream with a coroutine read(n), like
+    asyncio.StreamReader, by read_more
+    """
+
+    async def read_more(self):
+        """
+        Feed a block, or close at the end of input
+        """
+        block = await self.source.read(self.block_size)
+        if block:
+            self.feed(block)
+        else:
+            self.close()
+
+
+class AsyncOutputSink(OutputSink):
+    """
+    An OutputSink writing to an asyncio.StreamWriter, or anything with
+    write(bytes) and a coroutine drain()
+    """
+
+    def flush(self):
+        if not self.parts:
+            return
+        text = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        self.target.write(text.encode('utf-8'))
+
+    async def drain(self):
+        self.flush()
+        await self.target.drain()
+
+
+def async_source_of(source):
+    if isinstance(source, InputSource):
+        return source
+    read = getattr(source, 'read', None)
+    if read is not None and inspect.iscoroutinefunction(read):
+        return AsyncInputSource(source)
+    return source_of(source)
+
+
+def async_sink_of(output):
+    if isinstance(output, OutputSink):
+        return output
+    if hasattr(output, 'drain'):
+        return AsyncOutputSink(output)
+    return sink_of(output)
+
+
+class AsyncPYWSEngine(PYWSEngine):
+    """
+    PYWSEngine for asyncio, see the module doc.
+
+    input may also be an asyncio.StreamReader, output an
+    asyncio.StreamWriter; other inputs and outputs work as for PYWSEngine,
+    blocking the loop when they do.
+    """
+
+    def __init__(self, ins, stack=None, heap=None, output=None,
+                 input=None, int64=False, trap=False, quantum=QUANTUM):
+        super(AsyncPYWSEngine, self).__init__(
+            ins, stack, heap, async_sink_of(output), async_source_of(input),
+            int64, trap)
+        self.quantum = quantum
+
+    async def run_async(self):
+        """
+        Run the program to its end, return (stack, heap).
+        run works as for PYWSEngine, so a Scheduler can run this engine too
+        """
+        while True:
+            try:
+                if self.run_steps(self.quantum):
+                    break
+            except WouldBlock:
+                # let everyone see the output before waiting
+                await self.drain()
+                await self.input.read_more()
+                continue
+            await self.drain()
+            await asyncio.sleep(0)
+        await self.drain()
+        return self.stack, self.heap
+
+    async def drain(self):
+        if isinstance(self.output, AsyncOutputSink):
+            await self.output.drain()
+        else:
+            self.output.flush()
+
+    def reset(self, stack=None, heap=None, input=None):
+        if input is not None:
+            input = async_source_of(input)
+        super(AsyncPYWSEngine, self).reset(stack, heap, input)
+
+
+def serve(ins, host=None, port=None, path=None, **kwargs):
+    """
+    Start a server running ins, a program.Program or a list of
+    WSOperations, for every connection, on the unix socket path if given,
+    or on host and port.
+    kwargs go to every AsyncPYWSEngine.
+    Return the coroutine of asyncio.start_server or start_unix_server
+    """
+    if not isinstance(ins, Program):
+        ins = Program(ins)
+
+    async def session(reader, writer):
+        try:
+            await AsyncPYWSEngine(ins, output=writer, input=reader,
+                                  **kwargs).run_async()
+        finally:
+            writer.close()
+
+    if path is not None:
+        return asyncio.start_unix_server(session, path)
+    return asyncio.start_server(session, host, port)
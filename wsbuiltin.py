@@ -3,18 +3,40 @@
 All builtin operations defined in WhiteSpace
 """
 import operator
-import sys
+
+from memory import Heap, IntStack, MISSING
 
 
 class WSOperation:
     NAME = "WS"
     SRC = ""
     ARGS = 0
+    # True if the operation may store an int wider than 64 bits on the
+    # stack, which an IntStack refuses by OverflowError, before the
+    # operation has changed anything; any other OverflowError is the
+    # program's own
+    WIDENS = False
 
     def __call__(self, stack, heap, labels, engine, *args,
                  **kwargs):
         pass
 
+    def bind(self, engine, pc):
+        """
+        Pre-bind this operation at `pc` into a closure for the threaded
+        engine, the closure takes no argument and returns the next pc.
+
+        This generic version simply calls the operation, subclasses override
+        it with closures capturing the stack/heap methods they need.
+        """
+
+        def step():
+            engine.pc = pc
+            self(engine.stack, engine.heap, engine.labels, engine)
+            return engine.pc + 1
+
+        return step
+
     def __repr__(self):
         if self.ARGS:
             names = self.__init__.__code__.co_varnames
@@ -34,6 +56,8 @@ class WSOperation:
             return False
         if self.ARGS != other.ARGS:
             return False
+        if not self.ARGS:
+            return True
         self_names = self.__init__.__code__.co_varnames
         other_names = other.__init__.__code__.co_varnames
         if self_names != other_names:
@@ -64,6 +88,7 @@ class PUSH(StackOperation):
     NAME = "PUSH"
     SRC = "SS"
     ARGS = 1
+    WIDENS = True
 
     def __init__(self, val):
         self.val = val
@@ -71,6 +96,15 @@ class PUSH(StackOperation):
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
         stack.append(self.val)
 
+    def bind(self, engine, pc):
+        push, val, nxt = engine.stack.append, self.val, pc + 1
+
+        def step():
+            push(val)
+            return nxt
+
+        return step
+
 
 class POP(StackOperation):
     """
@@ -82,6 +116,15 @@ class POP(StackOperation):
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
         stack.pop()
 
+    def bind(self, engine, pc):
+        pop, nxt = engine.stack.pop, pc + 1
+
+        def step():
+            pop()
+            return nxt
+
+        return step
+
 
 class DUP(StackOperation):
     """
@@ -93,6 +136,16 @@ class DUP(StackOperation):
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
         stack.append(stack[-1])
 
+    def bind(self, engine, pc):
+        stack, nxt = engine.stack, pc + 1
+        push = stack.append
+
+        def step():
+            push(stack[-1])
+            return nxt
+
+        return step
+
 
 class COPY(StackOperation):
     """
@@ -107,7 +160,17 @@ class COPY(StackOperation):
         self.index = index
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        stack.append(stack[self.index])
+        stack.append(stack[-1 - self.index])
+
+    def bind(self, engine, pc):
+        stack, index, nxt = engine.stack, -1 - int(self.index), pc + 1
+        push = stack.append
+
+        def step():
+            push(stack[index])
+            return nxt
+
+        return step
 
 
 class SKIP(StackOperation):
@@ -116,18 +179,29 @@ class SKIP(StackOperation):
     """
     NAME = "SKIP"
     SRC = "STL"
+    ARGS = 1
 
     def __init__(self, n):
         self.n = n
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        if len(stack) - 1 > self.n:
-            for _ in range(self.n):
-                stack.pop(0)
-        else:
-            top = stack[-1]
-            stack.clear()
-            stack.append(top)
+        # the n items right under the top, or all of them if not so many
+        if not stack:
+            raise IndexError("SKIP on an empty stack")
+        if self.n > 0:
+            del stack[-1 - self.n:-1]
+
+    def bind(self, engine, pc):
+        stack, nxt = engine.stack, pc + 1
+        start = -1 - max(int(self.n), 0)
+
+        def step():
+            if not stack:
+                raise IndexError("SKIP on an empty stack")
+            del stack[start:-1]
+            return nxt
+
+        return step
 
 
 class SWAP(StackOperation):
@@ -140,6 +214,16 @@ class SWAP(StackOperation):
     def __call__(self, stack, heap, *args, **kwargs):
         stack[-1], stack[-2] = stack[-2], stack[-1]
 
+    def bind(self, engine, pc):
+        stack, nxt = engine.stack, pc + 1
+
+        def step():
+            # IndexError on a short stack, for IntStack too
+            stack[-1], stack[-2] = stack[-2], stack[-1]
+            return nxt
+
+        return step
+
 
 class HeapOperation(WSOperation):
     """
@@ -162,6 +246,32 @@ class STORE(HeapOperation):
         key = stack.pop()
         heap[key] = val
 
+    def bind(self, engine, pc):
+        pop, heap, nxt = engine.stack.pop, engine.heap, pc + 1
+        if not isinstance(heap, Heap):
+            def step():
+                val = pop()
+                heap[pop()] = val
+                return nxt
+
+            return step
+        dense, store = heap.dense, heap.__setitem__
+
+        def step():
+            val = pop()
+            key = pop()
+            # inline the dense region of Heap.__setitem__
+            try:
+                if key >= 0:
+                    dense[key] = val
+                    return nxt
+            except (IndexError, TypeError):
+                pass
+            store(key, val)
+            return nxt
+
+        return step
+
 
 class RETRIEVE(HeapOperation):
     """
@@ -170,11 +280,45 @@ class RETRIEVE(HeapOperation):
 
     NAME = "RETRIEVE"
     SRC = "TTT"
+    WIDENS = True
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        key = stack.pop()
-        val = heap[key]
-        stack.append(val)
+        # replace the key in place, an IntStack may refuse the value
+        stack[-1] = heap[stack[-1]]
+
+    def bind(self, engine, pc):
+        stack, heap, nxt = engine.stack, engine.heap, pc + 1
+        pop, push = stack.pop, stack.append
+        if isinstance(stack, IntStack):
+            def step():
+                stack[-1] = heap[stack[-1]]
+                return nxt
+
+            return step
+        if not isinstance(heap, Heap):
+            def step():
+                push(heap[pop()])
+                return nxt
+
+            return step
+        dense, load = heap.dense, heap.__getitem__
+
+        def step():
+            key = pop()
+            # inline the dense region of Heap.__getitem__
+            try:
+                if key >= 0:
+                    val = dense[key]
+                    if val is MISSING:
+                        raise KeyError(key)
+                    push(val)
+                    return nxt
+            except (IndexError, TypeError):
+                pass
+            push(load(key))
+            return nxt
+
+        return step
 
 
 class AlgebraOperation(WSOperation):
@@ -182,19 +326,42 @@ class AlgebraOperation(WSOperation):
     Basic Algebra Instruction
     """
     NAME = "Algebra"
+    WIDENS = True
 
     def __init__(self):
         self.op = operator.add
 
     @staticmethod
     def take_arg(stack):
-        a = stack.pop()
+        """
+        Return the second and the top item, as `second OP top`
+        """
         b = stack.pop()
+        a = stack.pop()
         return a, b
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        val = self.op(*AlgebraOperation.take_arg(stack))
-        stack.append(val)
+        # store before popping, so an overflow leaves the stack as it was
+        stack[-2] = self.op(stack[-2], stack[-1])
+        stack.pop()
+
+    def bind(self, engine, pc):
+        stack, op, nxt = engine.stack, self.op, pc + 1
+        pop, push = stack.pop, stack.append
+        if isinstance(stack, IntStack):
+            def step():
+                stack[-2] = op(stack[-2], stack[-1])
+                pop()
+                return nxt
+
+            return step
+
+        def step():
+            b = pop()
+            push(op(pop(), b))
+            return nxt
+
+        return step
 
 
 class ADD(AlgebraOperation):
@@ -214,7 +381,7 @@ class SUB(AlgebraOperation):
     TS-[Space][Tab]    Subtraction
     """
     NAME = "SUB"
-    SRC = "RSST"
+    SRC = "TSST"
 
     def __init__(self):
         super().__init__()
@@ -272,7 +439,16 @@ class PCHR(IOOperation):
     SRC = "TLSS"
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        sys.stdout.write(chr(stack.pop()))
+        engine.output.write(chr(stack.pop()))
+
+    def bind(self, engine, pc):
+        pop, write, nxt = engine.stack.pop, engine.output.write, pc + 1
+
+        def step():
+            write(chr(pop()))
+            return nxt
+
+        return step
 
 
 class PNUM(IOOperation):
@@ -283,7 +459,16 @@ class PNUM(IOOperation):
     SRC = "TLST"
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        sys.stdout.write(str(stack.pop()))
+        engine.output.write(str(stack.pop()))
+
+    def bind(self, engine, pc):
+        pop, write, nxt = engine.stack.pop, engine.output.write, pc + 1
+
+        def step():
+            write(str(pop()))
+            return nxt
+
+        return step
 
 
 class RCHR(IOOperation):
@@ -296,13 +481,22 @@ class RCHR(IOOperation):
     SRC = "TLTS"
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        while len(engine.buffer) == 0:
-            engine.buffer = list(input() + '\n')
-        c = engine.buffer.pop(0)
+        c = engine.input.read_char()
         key = stack.pop()
-        heap[key] = ord(c)
+        heap[key] = c
         if kwargs.get('debug', False):
-            print('STORE', '{:03d} ({!r})'.format(ord(c), c), '->', key)
+            print('STORE', '{:03d} ({!r})'.format(c, chr(c)), '->', key)
+
+    def bind(self, engine, pc):
+        pop, heap, nxt = engine.stack.pop, engine.heap, pc + 1
+        read = engine.input.read_char
+
+        def step():
+            c = read()
+            heap[pop()] = c
+            return nxt
+
+        return step
 
 
 class RNUM(IOOperation):
@@ -315,12 +509,23 @@ class RNUM(IOOperation):
     SRC = "TLTT"
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        s = int(input())
+        s = engine.input.read_number()
         key = stack.pop()
         heap[key] = s
         if kwargs.get('debug', False):
             print('STORE', s, '->', key)
 
+    def bind(self, engine, pc):
+        pop, heap, nxt = engine.stack.pop, engine.heap, pc + 1
+        read = engine.input.read_number
+
+        def step():
+            s = read()
+            heap[pop()] = s
+            return nxt
+
+        return step
+
 
 class FlowOperation(WSOperation):
     """
@@ -332,6 +537,15 @@ class FlowOperation(WSOperation):
     NAME = "CF"
 
 
+class JumpOperation(FlowOperation):
+    """
+    Flow Instruction jumping to a label,
+    the pc of the label is set to `target` by linker.link
+    """
+    NAME = "JOP"
+    target = None
+
+
 class MARK(FlowOperation):
     """
     L-[Space][Space] Mark a location in the program
@@ -344,10 +558,11 @@ class MARK(FlowOperation):
         self.label = label
 
     def __call__(self, stack, heap, labels, engine, *args, **kwargs):
-        labels[self.label] = engine.pc
+        # MARKs are resolved and dropped by linker.link before running
+        pass
 
 
-class CALL(FlowOperation):
+class CALL(JumpOperation):
     """
     L-[Space][Tab] Call a subroutine
     """
@@ -360,7 +575,16 @@ class CALL(FlowOperation):
 
     def __call__(self, stack, heap, labels, engine, *args,
                  **kwargs):
-        engine.call(self.label)
+        engine.call(self.target)
+
+    def bind(self, engine, pc):
+        call, target = engine.call_stack.append, self.target
+
+        def step():
+            call(pc)
+            return target
+
+        return step
 
 
 class PYFN(FlowOperation):
@@ -378,7 +602,7 @@ class PYFN(FlowOperation):
         engine.foreign(self.label)
 
 
-class JUMP(FlowOperation):
+class JUMP(JumpOperation):
     """
     L-[Space][LF] Jump unconditionally to a label
     """
@@ -391,10 +615,18 @@ class JUMP(FlowOperation):
 
     def __call__(self, stack, heap, labels, engine, *args,
                  **kwargs):
-        engine.pc = labels[self.label]
+        engine.pc = self.target - 1
 
+    def bind(self, engine, pc):
+        target = self.target
 
-class JS(FlowOperation):
+        def step():
+            return target
+
+        return step
+
+
+class JS(JumpOperation):
     """
     L-[Tab][Tab] Jump to a label if the top of the stack is negative
     """
@@ -409,10 +641,18 @@ class JS(FlowOperation):
                  **kwargs):
         top = stack.pop()
         if top < 0:
-            engine.pc = labels[self.label]
+            engine.pc = self.target - 1
+
+    def bind(self, engine, pc):
+        pop, target, nxt = engine.stack.pop, self.target, pc + 1
 
+        def step():
+            return target if pop() < 0 else nxt
 
-class JZ(FlowOperation):
+        return step
+
+
+class JZ(JumpOperation):
     """
     L-[Tab][Space] Jump to a label if the top of the stack is zero
     """
@@ -427,7 +667,15 @@ class JZ(FlowOperation):
                  **kwargs):
         top = stack.pop()
         if top == 0:
-            engine.pc = labels[self.label]
+            engine.pc = self.target - 1
+
+    def bind(self, engine, pc):
+        pop, target, nxt = engine.stack.pop, self.target, pc + 1
+
+        def step():
+            return target if pop() == 0 else nxt
+
+        return step
 
 
 class RET(FlowOperation):
@@ -441,6 +689,16 @@ class RET(FlowOperation):
                  **kwargs):
         engine.ret()
 
+    def bind(self, engine, pc):
+        call_stack, nxt = engine.call_stack, pc + 1
+
+        def step():
+            if call_stack:
+                return call_stack.pop() + 1
+            return nxt
+
+        return step
+
 
 class END(FlowOperation):
     """
@@ -453,6 +711,138 @@ class END(FlowOperation):
                  **kwargs):
         engine.end()
 
+    def bind(self, engine, pc):
+        end, stop = engine.end, engine.ins_len
+
+        def step():
+            end()
+            return stop
+
+        return step
+
+
+class SuperInstruction(WSOperation):
+    """
+    Fused Instruction, made by optimizer from common operation sequences,
+    never appears in WhiteSpace source
+    """
+    NAME = "SUPER"
+
+    def expand(self):
+        """
+        Return the list of operations this one is fused from
+        """
+        raise NotImplementedError
+
+
+class ADDI(SuperInstruction):
+    """
+    PUSH n ; ADD    Add n to the top of the stack
+    """
+    NAME = "ADDI"
+    ARGS = 1
+    WIDENS = True
+
+    def __init__(self, val):
+        self.val = val
+
+    def expand(self):
+        return [PUSH(self.val), ADD()]
+
+    def __call__(self, stack, heap, labels, engine, *args, **kwargs):
+        stack[-1] += self.val
+
+    def bind(self, engine, pc):
+        stack, val, nxt = engine.stack, self.val, pc + 1
+
+        def step():
+            stack[-1] += val
+            return nxt
+
+        return step
+
+
+class LOADK(SuperInstruction):
+    """
+    PUSH k ; RETRIEVE    Push the value stored at the constant address k
+    """
+    NAME = "LOADK"
+    ARGS = 1
+    WIDENS = True
+
+    def __init__(self, key):
+        self.key = key
+
+    def expand(self):
+        return [PUSH(self.key), RETRIEVE()]
+
+    def __call__(self, stack, heap, labels, engine, *args, **kwargs):
+        stack.append(heap[self.key])
+
+    def bind(self, engine, pc):
+        push, heap, key = engine.stack.append, engine.heap, self.key
+        nxt = pc + 1
+
+        def step():
+            push(heap[key])
+            return nxt
+
+        return step
+
+
+class STOREK(SuperInstruction):
+    """
+    PUSH k ; PUSH v ; STORE    Store the constant v at the constant address k
+    """
+    NAME = "STOREK"
+    ARGS = 2
+
+    def __init__(self, key, val):
+        self.key = key
+        self.val = val
+
+    def expand(self):
+        return [PUSH(self.key), PUSH(self.val), STORE()]
+
+    def __call__(self, stack, heap, labels, engine, *args, **kwargs):
+        heap[self.key] = self.val
+
+    def bind(self, engine, pc):
+        heap, key, val, nxt = engine.heap, self.key, self.val, pc + 1
+
+        def step():
+            heap[key] = val
+            return nxt
+
+        return step
+
+
+class DUPJZ(SuperInstruction, JumpOperation):
+    """
+    DUP ; JZ label    Jump to a label if the top of the stack is zero,
+    without discarding it
+    """
+    NAME = "DUPJZ"
+    ARGS = 1
+
+    def __init__(self, label):
+        self.label = label
+
+    def expand(self):
+        return [DUP(), JZ(self.label)]
+
+    def __call__(self, stack, heap, labels, engine, *args, **kwargs):
+        if stack[-1] == 0:
+            engine.pc = self.target - 1
+
+    def bind(self, engine, pc):
+        stack, target, nxt = engine.stack, self.target, pc + 1
+
+        def step():
+            return target if stack[-1] == 0 else nxt
+
+        return step
+
 
 class WSLiteral(object):
     NAME = "LITERAL"
@@ -513,8 +903,7 @@ class NUMBER(WSLiteral):
 
     def dump_literal(self):
         if self.val < 0:
-            return '1' + bin(-self.val)[2:].translate(
-                {ord('0'): '1', ord('1'): '0'})
+            return '1' + bin(-self.val)[2:]
         return '0' + bin(self.val)[2:]
 
     def __int__(self):
@@ -523,41 +912,59 @@ class NUMBER(WSLiteral):
     def __float__(self):
         return float(self.val)
 
+    def __index__(self):
+        return self.val
+
+    def __lt__(self, other):
+        return self.val < int(other)
+
+    def __gt__(self, other):
+        return self.val > int(other)
+
+    def __le__(self, other):
+        return self.val <= int(other)
+
+    def __ge__(self, other):
+        return self.val >= int(other)
+
+    def __neg__(self):
+        return -self.val
+
     def __add__(self, other):
-        return other.__add__(self.val)
+        return self.val + int(other)
 
     def __sub__(self, other):
-        return other.__sub__(self.val)
+        return self.val - int(other)
 
     def __mul__(self, other):
-        return other.__mul__(self.val)
+        return self.val * int(other)
 
     def __truediv__(self, other):
-        return other.__truediv__(self.val)
+        return self.val / int(other)
 
     def __floordiv__(self, other):
-        return other.__floordiv__(self.val)
+        return self.val // int(other)
 
     def __mod__(self, other):
-        return other.__mod__(self.val)
+        return self.val % int(other)
 
     def __radd__(self, other):
-        return other.__add__(self.val)
+        return int(other) + self.val
 
     def __rsub__(self, other):
-        return other.__sub__(self.val)
+        return int(other) - self.val
 
     def __rmul__(self, other):
-        return other.__mul__(self.val)
+        return int(other) * self.val
 
     def __rtruediv__(self, other):
-        return other.__truediv__(self.val)
+        return int(other) / self.val
 
     def __rfloordiv__(self, other):
-        return other.__floordiv__(self.val)
+        return int(other) // self.val
 
     def __rmod__(self, other):
-        return other.__mod__(self.val)
+        return int(other) % self.val
 
     def ir(self):
         return self.val
@@ -0,0 +1,253 @@
+# encoding=utf-8
+"""
+Buffered IO for the engines.
+"""
+import io
+import os
+import sys
+import weakref
+
+# chars buffered by an OutputSink before it flushes
+BUFFER_SIZE = 8192
+# bytes read at a time by an InputSource
+BLOCK_SIZE = 1 << 16
+
+
+class WouldBlock(Exception):
+    """
+    A FeedSource has not been fed enough input yet
+    """
+
+
+class OutputSink(object):
+    """
+    Collect the output of PCHR and PNUM, and write it to the target at
+    once, when buffer_size chars are buffered, or flush is called.
+
+    The target may be a text stream, a binary stream, or a file descriptor.
+    If not given, it is sys.stdout at the time of flushing.
+    """
+
+    def __init__(self, target=None, buffer_size=BUFFER_SIZE):
+        self.target = target
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def getvalue(self):
+        """
+        What is buffered and not flushed yet
+        """
+        return ''.join(self.parts)
+
+    def flush(self):
+        if not self.parts:
+            return
+        text = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        target = self.target if self.target is not None else sys.stdout
+        if isinstance(target, int):
+            data = memoryview(text.encode('utf-8'))
+            while data:
+                data = data[os.write(target, data):]
+            return
+        if isinstance(target, (io.RawIOBase, io.BufferedIOBase)):
+            target.write(text.encode('utf-8'))
+        else:
+            target.write(text)
+        target.flush()
+
+
+def sink_of(output):
+    """
+    Return output if it is an OutputSink already, or a new one targeting it
+    """
+    if isinstance(output, OutputSink):
+        return output
+    return OutputSink(output)
+
+
+class InputSource(object):
+    """
+    Serve RCHR and RNUM from a buffer, filled block by block.
+
+    The source may be bytes or str holding all the input (never blocks),
+    a binary or text stream, or a file descriptor.
+    If not given, it is sys.stdin at the time of reading.
+    before_fill is called before reading more, which may block.
+
+    A text stream is read a line at a time through its text layer, so
+    nothing it has buffered is skipped; use source_of for stdin, which
+    shares one InputSource, so no engine loses what another read ahead.
+    """
+
+    def __init__(self, source=None, block_size=BLOCK_SIZE, before_fill=None):
+        self.source = source
+        self.block_size = block_size
+        self.before_fill = before_fill
+        self.data = b''
+        self.pos = 0
+        self.eof = False
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        if isinstance(source, (bytes, bytearray)):
+            self.data, self.eof = bytes(source), True
+
+    def read_block(self):
+        source = self.source if self.source is not None else sys.stdin
+        if isinstance(source, int):
+            return os.read(source, self.block_size)
+        if isinstance(source, io.TextIOBase) or hasattr(source, 'buffer'):
+            # a line at a time, so an interactive session never hangs
+            return source.readline().encode('utf-8')
+        return self.read_stream(source)
+
+    def read_stream(self, stream):
+        if hasattr(stream, 'read1'):
+            return stream.read1(self.block_size)
+        return stream.read(self.block_size)
+
+    def fill(self):
+        """
+        Append a block to the unread data, return False at the end of input
+        """
+        if self.eof:
+            return False
+        if self.before_fill is not None:
+            self.before_fill()
+        block = self.read_block()
+        if not block:
+            self.eof = True
+            return False
+        self.data = self.data[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def read_char(self):
+        """
+        Return the code point of the next UTF-8 character
+        """
+        if self.pos >= len(self.data) and not self.fill():
+            raise EOFError
+        lead = self.data[self.pos]
+        if lead < 0x80:
+            self.pos += 1
+            return lead
+        width = 2 if 0xC2 <= lead < 0xE0 else 3 if 0xE0 <= lead < 0xF0 \
+            else 4 if 0xF0 <= lead < 0xF5 else 1
+        if width > 1:
+            while len(self.data) - self.pos < width and self.fill():
+                pass
+            try:
+                char = self.data[self.pos:self.pos + width].decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                self.pos += width
+                return ord(char)
+        # an invalid byte is replaced alone, the next one is read again
+        self.pos += 1
+        return 0xFFFD
+
+    def read_line(self):
+        """
+        Return the next line without the line break
+        """
+        scan = self.pos
+        while True:
+            stop = self.data.find(b'\n', scan)
+            if stop >= 0:
+                break
+            # fill keeps the unread data from pos, which is already scanned
+            scan = len(self.data) - self.pos
+            if not self.fill():
+                if self.pos >= len(self.data):
+                    raise EOFError
+                stop = len(self.data)
+                break
+        line = self.data[self.pos:stop]
+        self.pos = stop + 1
+        return line
+
+    def read_number(self):
+        return int(self.read_line())
+
+    def remaining(self):
+        """
+        The unread input which is buffered
+        """
+        return self.data[self.pos:]
+
+    def ready(self):
+        """
+        False if reading is known to raise WouldBlock
+        """
+        return True
+
+
+class FeedSource(InputSource):
+    """
+    An InputSource holding what is given by feed, until close.
+    It never waits: reading past what is fed raises WouldBlock, before
+    the engine changes anything, so the read can be run again once more
+    is fed.
+    """
+
+    def __init__(self, source=None, block_size=BLOCK_SIZE):
+        super(FeedSource, self).__init__(None, block_size)
+        self.source = source
+        self.starved = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        self.starved = True
+        raise WouldBlock
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = self.data[self.pos:] + data
+        self.pos = 0
+        self.starved = False
+
+    def close(self):
+        """
+        There is no more input, reading past the fed data is EOFError
+        """
+        self.eof = True
+        self.starved = False
+
+    def ready(self):
+        return not self.starved
+
+
+# the standard input stream => the InputSource shared by every engine
+_shared = weakref.WeakKeyDictionary()
+
+
+def source_of(source):
+    """
+    Return source if it is an InputSource already, the shared one of the
+    standard input if source is None or sys.stdin, or a new one reading it
+    """
+    if isinstance(source, InputSource):
+        return source
+    stdin = sys.stdin
+    if source is None or (source is stdin and stdin is not None):
+        try:
+            shared = _shared.get(stdin)
+            if shared is None:
+                shared = _shared[stdin] = InputSource(stdin)
+            return shared
+        except TypeError:
+            # not weakly referable, like None
+            return InputSource(source)
+    return InputSource(source)
@@ -1,95 +1,252 @@
 # encoding=utf-8
+import functools
+import mmap
 import os
 from style import STL
 from wstoken import IMP
 from wsbuiltin import END
 
 
+# bytes translated at a time when reading a memory-mapped source file
+CHUNK = 1 << 20
+
+
+class StyleTable(dict):
+    """
+    str.translate table of a style, deleting every char not in the style
+    """
+
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def byte_table(items):
+    """
+    bytes.translate table and deletion bytes for an ASCII-only style
+    """
+    style = dict(items)
+    table = bytearray(range(256))
+    for c, op in style.items():
+        table[ord(c)] = ord(op)
+    delete = bytes(b for b in range(256) if chr(b) not in style)
+    return bytes(table), delete
+
+
 class Reader(object):
     """
     This is the source code reader for WhiteSpace.
+
+    The source is filtered into compact STL strings by str.translate, or
+    bytes.translate for ASCII-only styles, chunk by chunk. Source files are
+    memory-mapped, so they are never copied as a whole.
     """
 
     def __init__(self, source: str, style: dict=STL):
-        if not isinstance(source, str):
+        if not isinstance(source, (str, bytes, bytearray)):
             raise TypeError("{} is neither a string containing source code "
                             "nor a path to source file".format(str(source)))
-        if os.path.exists(source):
-            with open(source) as sf:
-                source = sf.read()
-        self.source = source
+        self.path = None
+        if isinstance(source, str) and os.path.exists(source):
+            self.path = source
+            source = None
+        self._source = source
+        self._code = None
         self.style = style
-        self.doc = filter(lambda c: c not in self.style, source)
-        self.code = tuple(filter(None,
-                                 map(lambda c: self.style.get(c, None),
-                                     self.source)))
+
+    @property
+    def source(self):
+        if self._source is None:
+            with open(self.path) as sf:
+                return sf.read()
+        if isinstance(self._source, str):
+            return self._source
+        return self._source.decode('utf-8')
+
+    @property
+    def doc(self):
+        """
+        Everything in the source which is not code, computed on demand
+        """
+        return self.source.translate({ord(c): None for c in self.style})
+
+    @property
+    def code(self):
+        """
+        The whole STL code, computed on demand
+        """
+        if self._code is None:
+            self._code = ''.join(self.chunks())
+        return self._code
+
+    def chunks(self, size=None):
+        """
+        Yield the STL code, translated from at most `size` source bytes
+        (or chars) at a time, default: CHUNK
+        """
+        size = size or CHUNK
+        if self._code is not None:
+            yield self._code
+            return
+        if not all(len(c) == 1 and ord(c) < 128 for c in self.style):
+            table = StyleTable((ord(c), op) for c, op in self.style.items())
+            if self.path is None:
+                source = self.source
+                for pos in range(0, len(source), size):
+                    yield source[pos:pos + size].translate(table)
+                return
+            with open(self.path) as sf:
+                for text in iter(lambda: sf.read(size), ''):
+                    yield text.translate(table)
+            return
+        table, delete = byte_table(tuple(sorted(self.style.items())))
+        if self.path is None:
+            data = self._source
+            encode = isinstance(data, str)
+            for pos in range(0, len(data), size):
+                part = data[pos:pos + size]
+                if encode:
+                    part = part.encode('utf-8')
+                yield part.translate(table, delete).decode('ascii')
+            return
+        with open(self.path, 'rb') as sf:
+            length = os.fstat(sf.fileno()).st_size
+            if not length:
+                return
+            with mmap.mmap(sf.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for pos in range(0, length, size):
+                    yield m[pos:pos + size].translate(table,
+                                                      delete).decode('ascii')
 
     def __iter__(self):
         return iter(self.code)
 
 
+# the column of each STL char in the transition table
+OFFSET = {'S': 0, 'T': 1, 'L': 2}
+# a transition with no instruction
+INVALID = 1 << 30
+
+
+def compile_imp(root):
+    """
+    Compile the nested IMP dicts of wstoken into a flat transition table.
+
+    States are multiples of 3, table[state + OFFSET[c]] is the next state,
+    or -1 - k for accepting ACTIONS[k], a (class, literal class) tuple,
+    or INVALID.
+    The last state is the dead end of an unfinished IMP, any char after it
+    is INVALID.
+    """
+    states = {id(root): 0}
+    nodes = [root]
+    table = []
+    actions = []
+
+    def accept(leaf):
+        cls, _, literal = leaf
+        actions.append((cls, literal))
+        return -len(actions)
+
+    def goto(node):
+        if id(node) not in states:
+            states[id(node)] = len(nodes) * 3
+            nodes.append(node)
+        return states[id(node)]
+
+    dead = {}
+    for node in nodes:
+        for c in 'STL':
+            if c not in node:
+                table.append(INVALID)
+                continue
+            result = node[c]
+            if isinstance(result, tuple) and len(result) == 3:
+                table.append(accept(result))
+                continue
+            next_level, leaf = result if result else (None, None)
+            if leaf and not isinstance(leaf, dict):
+                table.append(accept(leaf))
+            elif leaf:
+                table.append(goto(leaf))
+            elif next_level:
+                table.append(goto(next_level))
+            else:
+                table.append(goto(dead))
+    return table, actions
+
+
+TABLE, ACTIONS = compile_imp(IMP)
+
+
 class Lexer(object):
     """
     This is the lexer for WhiteSpace
+
+    If lazy is True, tokens are only lexed while iterating, chunk by chunk
+    from the reader, and never kept in memory.
     """
 
-    def __init__(self, reader: Reader, strict=False):
+    def __init__(self, reader: Reader, strict=False, lazy=False):
         self.reader = reader
         self.strict = strict
-        self.ins = self.lex()
+        self.ins = None if lazy else self.lex()
 
     def lex(self):
+        return list(self.tokens())
+
+    def chunks(self):
+        if hasattr(self.reader, 'chunks'):
+            return self.reader.chunks()
+        return [''.join(self.reader)]
+
+    def tokens(self):
+        """
+        Yield tokens, literals and the state of the DFA may span
+        over chunks
+        """
+        table, actions, offset = TABLE, ACTIONS, OFFSET
         found_end = False
-        status = IMP
-        literal_buffer = []
         literal = None
-        ins = []
-        for c in self.reader:
+        literal_buffer = []
+        state = 0
+        for code in self.chunks():
+            pos, length = 0, len(code)
             if literal is not None:
-                if c != 'L':
-                    literal_buffer.append(c)
-                else:
-                    ins.append(literal(''.join(literal_buffer)))
-                    # use this instead of literal_buffer.clear()
-                    # so that this will work in PyPy3
-                    literal_buffer = []
+                stop = code.find('L')
+                if stop < 0:
+                    literal_buffer.append(code)
+                    continue
+                literal_buffer.append(code[:stop])
+                yield literal(''.join(literal_buffer))
+                literal, literal_buffer = None, []
+                pos = stop + 1
+            while pos < length:
+                state = table[state + offset[code[pos]]]
+                pos += 1
+                if state >= 0:
+                    if state == INVALID:
+                        raise SyntaxError("Invalid instruction")
+                    continue
+                cls, literal = actions[-1 - state]
+                state = 0
+                if cls is END:
+                    found_end = True
+                yield cls
+                if literal is not None:
+                    stop = code.find('L', pos)
+                    if stop < 0:
+                        literal_buffer.append(code[pos:])
+                        break
+                    yield literal(code[pos:stop])
                     literal = None
-                continue
-            if isinstance(status, dict):
-                result = status[c]
-                if isinstance(result, tuple) and len(result) == 3:
-                    cls, args, literal = result
-                    if cls is END:
-                        found_end = True
-                    ins.append(cls)
-                    status = IMP
-                else:
-                    next_level, leaf = result
-                    if leaf and not isinstance(leaf, dict):
-                        cls, args, literal = leaf
-                        if cls is END:
-                            found_end = True
-                        ins.append(cls)
-                        status = IMP
-                    elif leaf and isinstance(leaf, dict):
-                        status = leaf
-                    else:
-                        status = next_level
-            else:
-                raise SyntaxError
-        if self.strict and any((literal_buffer, literal,
-                                status != IMP,
+                    pos = stop + 1
+        if self.strict and any((literal is not None, state != 0,
                                 not found_end)):
             raise SyntaxError("Not end at L-[LF][LF] END")
-        return ins
 
     def __iter__(self):
+        if self.ins is None:
+            return self.tokens()
         return iter(self.ins)
-
-
-
-
-
-
-
-
@@ -0,0 +1,202 @@
+# encoding=utf-8
+"""
+Execution profiles, for PYWSEngine.run_profiled.
+
+A Profile counts how many times every pc ran and how long it took. The pcs
+are grouped by the opcode of their instruction, and by the region of the
+MARK before them. Every CALL target region also gets its call count and
+inclusive time, from the engine's call_stack.
+
+The result is a sorted table (Profile.table), a pstats file for
+pstats.Stats / snakeviz (Profile.dump_stats), or collapsed stacks for
+flamegraph.pl / speedscope (Profile.dump_collapsed).
+"""
+import marshal
+import time
+
+MAIN = '<main>'
+FILENAME = '<ws>'
+COLUMNS = {'region': ('steps', 'calls', 'self', 'total'),
+           'op': ('steps', 'self'),
+           'pc': ('steps', 'self')}
+
+
+def region_name(label):
+    return 'MARK {}'.format(label)
+
+
+class Profile(object):
+    """
+    The profile of one or more runs of an engine,
+    clock is a function returning seconds
+    """
+
+    def __init__(self, engine, clock=time.perf_counter):
+        self.clock = clock
+        self.ins = engine.ins
+        size = engine.ins_len
+        # indexed by pc
+        self.counts = [0] * size
+        self.times = [0.0] * size
+        self.regions = [MAIN] * size
+        starts = {}
+        for label, pc in engine.labels.items():
+            # the first one wins for labels marking the same pc
+            starts.setdefault(pc, region_name(label))
+        region = MAIN
+        for pc in range(size):
+            region = starts.get(pc, region)
+            self.regions[pc] = region
+        self.starts = {name: pc for pc, name in starts.items()}
+        self.starts[MAIN] = 0
+        # region name => count / seconds, for CALL targets
+        self.calls = {}
+        self.inclusive = {}
+        # (caller, callee) => count / seconds
+        self.edges = {}
+        self.edge_times = {}
+        # the running calls, (region, caller, begin)
+        self.frames = []
+        self.path = (MAIN,)
+        # (call path, region) => seconds spent in it
+        self.stacks = {}
+        self.total = 0.0
+
+    def enter(self, target, begin):
+        """
+        A CALL has just gone to pc target, the step began at begin
+        """
+        callee = self.regions[target] if target < len(self.regions) else MAIN
+        caller = self.path[-1]
+        self.calls[callee] = self.calls.get(callee, 0) + 1
+        edge = (caller, callee)
+        self.edges[edge] = self.edges.get(edge, 0) + 1
+        self.frames.append((callee, caller, begin))
+        self.path += (callee,)
+
+    def leave(self, now):
+        """
+        A RET has just gone back to the caller
+        """
+        if not self.frames:
+            return
+        callee, caller, begin = self.frames.pop()
+        self.path = self.path[:-1]
+        spent = now - begin
+        # a recursive call is within the outer one already
+        if callee not in self.path:
+            self.inclusive[callee] = self.inclusive.get(callee, 0.0) + spent
+        edge = (caller, callee)
+        self.edge_times[edge] = self.edge_times.get(edge, 0.0) + spent
+
+    def finish(self, now, spent):
+        """
+        The run has stopped after spent seconds, leave the calls still
+        running as if they returned now
+        """
+        while self.frames:
+            self.leave(now)
+        self.total += spent
+
+    def region_totals(self):
+        """
+        region name => [steps, self seconds]
+        """
+        totals = {MAIN: [0, 0.0]}
+        for pc, region in enumerate(self.regions):
+            row = totals.setdefault(region, [0, 0.0])
+            row[0] += self.counts[pc]
+            row[1] += self.times[pc]
+        return totals
+
+    def rows(self, by='region'):
+        """
+        The rows of the table, (name, *COLUMNS[by]), in no order
+        """
+        if by == 'region':
+            rows = []
+            for region, (steps, spent) in self.region_totals().items():
+                if region == MAIN:
+                    total = self.total
+                else:
+                    total = self.inclusive.get(region, spent)
+                rows.append((region, steps, self.calls.get(region, 0), spent,
+                             total))
+            return rows
+        if by == 'op':
+            totals = {}
+            for pc, op in enumerate(self.ins):
+                row = totals.setdefault(op.NAME, [0, 0.0])
+                row[0] += self.counts[pc]
+                row[1] += self.times[pc]
+            return [(name, steps, spent)
+                    for name, (steps, spent) in totals.items()]
+        if by == 'pc':
+            return [('{} {!r}'.format(pc, op), self.counts[pc], self.times[pc])
+                    for pc, op in enumerate(self.ins) if self.counts[pc]]
+        raise ValueError("Cannot group a profile by {!r}".format(by))
+
+    def table(self, by='region', sort='self', limit=None):
+        """
+        The profile grouped by region, op or pc, as text sorted by
+        one of the columns, largest first
+        """
+        columns = COLUMNS[by] if by in COLUMNS else ()
+        rows = self.rows(by)
+        if sort not in columns:
+            raise ValueError("Cannot sort by {!r}, try one of {}"
+                             .format(sort, ', '.join(columns)))
+        key = columns.index(sort) + 1
+        rows.sort(key=lambda row: (-row[key], row[0]))
+        lines = [('{:>12}' * len(columns)).format(*columns) + '  ' + by]
+        for row in rows[:limit]:
+            cells = ['{:>12}'.format(v) if isinstance(v, int) else
+                     '{:>12.6f}'.format(v) for v in row[1:]]
+            lines.append(''.join(cells) + '  ' + row[0])
+        return '\n'.join(lines)
+
+    def stats(self):
+        """
+        The regions in the format of cProfile.Profile.stats,
+        each region is a function at the line of its pc
+        """
+
+        def func(region):
+            return FILENAME, self.starts[region], region
+
+        callers = {}
+        for (caller, callee), count in self.edges.items():
+            spent = self.edge_times.get((caller, callee), 0.0)
+            callers.setdefault(callee, {})[func(caller)] = (count, count, 0.0,
+                                                            spent)
+        stats = {}
+        for region, steps, calls, spent, total in self.rows('region'):
+            calls = calls or 1
+            stats[func(region)] = (calls, calls, spent, total,
+                                   callers.get(region, {}))
+        return stats
+
+    def dump_stats(self, path):
+        """
+        Write a file to be read by pstats.Stats
+        """
+        with open(path, 'wb') as f:
+            marshal.dump(self.stats(), f)
+
+    def collapsed(self):
+        """
+        Lines of `caller;...;region microseconds`, the regions run by
+        the same call path are stacked over the region called
+        """
+        lines = []
+        for (path, region), spent in sorted(self.stacks.items()):
+            frames = path if path[-1] == region else path + (region,)
+            micros = int(round(spent * 1e6))
+            if micros:
+                lines.append('{} {}'.format(';'.join(frames), micros))
+        return lines
+
+    def dump_collapsed(self, path):
+        with open(path, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
@@ -0,0 +1,317 @@
+# encoding=utf-8
+"""
+Delta-encoded execution traces, for PYWSEngine.run(traceall=...).
+
+Instead of a copy of the whole state after every step, a Trace records what
+each step changed: how many items it cut off the top of the stack, the items
+it left there, and the heap cells it wrote. Every `interval` steps a full
+checkpoint is taken, the state after any step is rebuilt from the checkpoint
+before it.
+
+A Trace may keep only the last `ring` steps in memory, and stream every
+record to a binary file, to be read back by wstrace.load.
+"""
+from collections import deque
+from itertools import islice
+
+from wsbuiltin import POP, SKIP, SWAP, STORE, RETRIEVE
+from wsbuiltin import AlgebraOperation, PCHR, PNUM, RCHR, RNUM
+from wsbuiltin import PUSH, DUP, COPY, MARK, CALL, JUMP, JS, JZ, RET, END
+from wsbuiltin import ADDI, LOADK, STOREK, DUPJZ, LABEL
+from memory import Heap
+
+MAGIC = b'PYWSTRC2'
+STEP, CHECKPOINT = 0, 1
+# how many items under the top an operation may change,
+# the whole stack for anything not listed (like PYFN)
+REWRITES = {PUSH: 0, DUP: 0, COPY: 0, MARK: 0, CALL: 0, JUMP: 0, RET: 0,
+            END: 0, LOADK: 0, STOREK: 0, DUPJZ: 0,
+            POP: 1, RETRIEVE: 1, PCHR: 1, PNUM: 1, RCHR: 1, RNUM: 1,
+            JS: 1, JZ: 1, ADDI: 1,
+            SWAP: 2, STORE: 2}
+
+
+def rewrites(op, stack):
+    cls = type(op)
+    if cls in REWRITES:
+        return REWRITES[cls]
+    if isinstance(op, AlgebraOperation):
+        return 2
+    if cls is SKIP:
+        return max(int(op.n), 0) + 1
+    return len(stack)
+
+
+def written(op, stack):
+    """
+    The heap addresses op is going to write
+    """
+    cls = type(op)
+    if cls is STORE:
+        return stack[-2],
+    if cls is RCHR or cls is RNUM:
+        return stack[-1],
+    if cls is STOREK:
+        return op.key,
+    return ()
+
+
+def pack_uint(out, n):
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def unpack_uint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def pack_int(out, n):
+    # zigzag, small negative numbers stay short
+    pack_uint(out, n << 1 if n >= 0 else (~n << 1) | 1)
+
+
+def unpack_int(data, pos):
+    n, pos = unpack_uint(data, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def pack_value(out, val):
+    """
+    An int (or NUMBER) as a tagged zigzag varint, a str as its UTF-8 bytes,
+    a LABEL as its literal
+    """
+    if isinstance(val, (str, LABEL)):
+        tag = 1
+        if isinstance(val, LABEL):
+            tag, val = 3, val.literal
+        raw = val.encode('utf-8')
+        pack_uint(out, len(raw) << 2 | tag)
+        out += raw
+        return
+    n = val.__index__()
+    pack_uint(out, (n << 2 if n >= 0 else (~n << 2) | 2))
+
+
+def unpack_value(data, pos):
+    n, pos = unpack_uint(data, pos)
+    if n & 1:
+        end = pos + (n >> 2)
+        text = bytes(data[pos:end]).decode('utf-8')
+        return (LABEL(text) if n & 2 else text), end
+    return (n >> 2) ^ -(n >> 1 & 1), pos
+
+
+def pack_values(out, vals):
+    pack_uint(out, len(vals))
+    for val in vals:
+        pack_value(out, val)
+
+
+def unpack_values(data, pos):
+    count, pos = unpack_uint(data, pos)
+    vals = []
+    for _ in range(count):
+        val, pos = unpack_value(data, pos)
+        vals.append(val)
+    return vals, pos
+
+
+class Trace(object):
+    """
+    The history of a run, trace[i] is (pc, None, stack, heap) after step i,
+    trace[0] is the state before the first step.
+
+    interval: steps between two checkpoints, 0 for no more checkpoints
+    ring: if given, keep about the last ring steps only
+    out: a path or a binary file to stream the records to
+    """
+
+    def __init__(self, interval=1024, ring=None, out=None,
+                 buffer_size=1 << 16):
+        self.interval = interval
+        self.ring = ring
+        # deltas[k] is (pc, cut, tail, writes) of step base + 1 + k
+        self.deltas = deque()
+        self.base = 0
+        self.steps = 0
+        # step => (pc, stack, heap)
+        self.checkpoints = {}
+        # the step of the last checkpoint
+        self.last = 0
+        # what the running step may change, and the stack size before it
+        self.pending = None
+        self.size = 0
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.file = None
+        self.own_file = False
+        if out is not None:
+            if isinstance(out, str):
+                self.file, self.own_file = open(out, 'wb'), True
+            else:
+                self.file = out
+            self.buffer += MAGIC
+
+    def __len__(self):
+        return self.steps + 1
+
+    def start(self, engine):
+        """
+        Record the state before the first step
+        """
+        self.checkpoint(engine.pc, engine.stack, engine.heap)
+
+    def before(self, op, stack):
+        """
+        Remember what op may change, it is going to run on stack
+        """
+        self.pending = (len(stack) - min(rewrites(op, stack), len(stack)),
+                        written(op, stack))
+
+    def after(self, pc, stack, heap):
+        """
+        Record the step which has just run, pc as it left the engine
+        """
+        low, keys = self.pending
+        size = len(stack)
+        # the items under low are kept, unless the stack got shorter
+        low = min(low, size)
+        tail = tuple(stack[low:])
+        writes = tuple((key, heap[key]) for key in keys)
+        self.add(pc, self.size - low, tail, writes)
+        self.size = size
+        if self.interval and self.steps % self.interval == 0:
+            self.checkpoint(pc, stack, heap)
+        elif self.ring is not None and self.steps - self.last >= self.ring:
+            # trimming needs a checkpoint to rebuild the kept steps from
+            self.checkpoint(pc, stack, heap)
+
+    def add(self, pc, cut, tail, writes):
+        self.steps += 1
+        self.deltas.append((pc, cut, tail, writes))
+        if self.file is not None:
+            out = self.buffer
+            out.append(STEP)
+            pack_int(out, pc)
+            pack_uint(out, cut)
+            pack_values(out, tail)
+            pack_uint(out, len(writes))
+            for key, val in writes:
+                pack_value(out, key)
+                pack_value(out, val)
+            if len(out) >= self.buffer_size:
+                self.flush()
+
+    def checkpoint(self, pc, stack, heap):
+        stack = list(stack)
+        heap = dict(heap.items())
+        self.checkpoints[self.steps] = (pc, stack, heap)
+        self.last = self.steps
+        self.size = len(stack)
+        if self.file is not None:
+            out = self.buffer
+            out.append(CHECKPOINT)
+            pack_uint(out, self.steps)
+            pack_int(out, pc)
+            pack_values(out, stack)
+            pack_uint(out, len(heap))
+            for key, val in heap.items():
+                pack_value(out, key)
+                pack_value(out, val)
+        if self.ring is not None:
+            self.trim()
+
+    def trim(self):
+        """
+        Forget the checkpoints and steps older than ring steps,
+        keeping the checkpoint they are rebuilt from
+        """
+        keep = max(s for s in self.checkpoints
+                   if s <= max(self.steps - self.ring, 0))
+        for step in [s for s in self.checkpoints if s < keep]:
+            del self.checkpoints[step]
+        while self.base < keep:
+            self.deltas.popleft()
+            self.base += 1
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        if self.own_file:
+            self.file.close()
+        self.file = None
+
+    def __getitem__(self, step):
+        if step < 0:
+            step += len(self)
+        if not self.base <= step <= self.steps:
+            raise IndexError(step)
+        mark = max(s for s in self.checkpoints if s <= step)
+        pc, stack, heap = self.checkpoints[mark]
+        stack, heap = list(stack), Heap(heap)
+        for pc, cut, tail, writes in islice(self.deltas, mark - self.base,
+                                            step - self.base):
+            if cut:
+                del stack[-cut:]
+            stack.extend(tail)
+            for key, val in writes:
+                heap[key] = val
+        return pc, None, stack, heap
+
+    def __iter__(self):
+        for step in range(self.base, self.steps + 1):
+            yield self[step]
+
+
+def load(path, ring=None):
+    """
+    Read a Trace streamed to path back into memory,
+    with the checkpoints it was written with
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a PYWS trace: {}".format(path))
+    # checkpoints come from the file only
+    trace = Trace(interval=0, ring=ring)
+    pos = len(MAGIC)
+    while pos < len(data):
+        kind = data[pos]
+        if kind == CHECKPOINT:
+            # the step is implied, checkpoints follow the steps in order
+            _, pos = unpack_uint(data, pos + 1)
+            pc, pos = unpack_int(data, pos)
+            stack, pos = unpack_values(data, pos)
+            count, pos = unpack_uint(data, pos)
+            heap = {}
+            for _ in range(count):
+                key, pos = unpack_value(data, pos)
+                heap[key], pos = unpack_value(data, pos)
+            trace.checkpoint(pc, stack, heap)
+        elif kind == STEP:
+            pc, pos = unpack_int(data, pos + 1)
+            cut, pos = unpack_uint(data, pos)
+            tail, pos = unpack_values(data, pos)
+            count, pos = unpack_uint(data, pos)
+            writes = []
+            for _ in range(count):
+                key, pos = unpack_value(data, pos)
+                val, pos = unpack_value(data, pos)
+                writes.append((key, val))
+            trace.add(pc, cut, tuple(tail), tuple(writes))
+        else:
+            raise ValueError("Broken PYWS trace at byte {}".format(pos))
+    return trace